@@ -1,3 +1,18 @@
+# The ALU comes in several flavours. `alu` is the reference model: it works on
+# "0"/"1" strings exactly like the Hack chip does, one bit at a time. `alu_int`
+# computes the same function on masked 64-bit Python ints, step by step like
+# the chip, and is kept as the oracle tests/test_alu.py checks the others
+# against. The CPU uses `alu_fn`, which specialises it to one instruction's
+# control bits.
+
+WIDTH = 64
+MASK = (1 << WIDTH) - 1
+SIGN = 1 << (WIDTH - 1)
+
+def signed64(v):
+    """A masked word read as a two's-complement signed int."""
+    return v - (1 << WIDTH) if v & SIGN else v
+
 def b_and(a,b):
     out = ""
     for i in range(len(a)):
@@ -38,3 +53,70 @@ def alu(x,y,zx,nx,zy,ny,f,no):
     ng = "1" if out[0] == "1" else "0"
 
     return out,zr,ng
+
+def alu_int(x,y,zx,nx,zy,ny,f,no):
+    # x and y are unsigned 64-bit ints (already masked); so is out.
+    if zx: x = 0
+
+    if nx: x ^= MASK
+
+    if zy: y = 0
+
+    if ny: y ^= MASK
+
+    if f: out = (x + y) & MASK
+
+    else: out = x & y
+
+    if no: out ^= MASK
+
+    zr = 1 if out == 0 else 0
+
+    ng = 1 if out & SIGN else 0
+
+    return out,zr,ng
+
+def alu_fn(zx,nx,zy,ny,f,no):
+    # Specialise alu_int for one fixed set of control bits. zx/zy and nx/ny/no
+    # become an AND mask and an XOR mask, so the returned function does no
+    # branching of its own; the CPU decodes each C-instruction into one of these.
+    kx = 0 if zx else MASK
+    mx = MASK if nx else 0
+    ky = 0 if zy else MASK
+    my = MASK if ny else 0
+    mo = MASK if no else 0
+    if f:
+        return lambda x, y: ((((x & kx) ^ mx) + ((y & ky) ^ my)) & MASK) ^ mo
+    return lambda x, y: (((x & kx) ^ mx) & ((y & ky) ^ my)) ^ mo
+
+def alu_ref_fn(zx,nx,zy,ny,f,no):
+    # Same contract as alu_fn, but evaluated by the bit-string reference ALU.
+    def comp(x, y):
+        out, _, _ = alu(format(x, f"0{WIDTH}b"), format(y, f"0{WIDTH}b"), zx, nx, zy, ny, f, no)
+        return int(out, 2)
+    return comp
+
+# Extended instruction set (assembler.ext_comp_table): comp codes the Hack
+# ALU leaves unused, run as whole operations instead of through the control
+# bits. Keyed by (a_bit, comp_bits); same contract as alu_fn's functions.
+# Values are signed: >> keeps the sign bit, / truncates toward zero and %
+# takes the sign of the dividend, and dividing by zero gives quotient 0 and
+# remainder x, all like the compiler's DIV routine.
+
+def ext_div(x, y):
+    if y == 0:
+        return 0
+    x, y = signed64(x), signed64(y)
+    q = abs(x) // abs(y)
+    return (q if (x < 0) == (y < 0) else -q) & MASK
+
+def ext_mod(x, y):
+    return (x - y * ext_div(x, y)) & MASK
+
+ext_ops = {
+    (0, 0b101000): lambda x, y: (x << 1) & MASK,  # D<<1
+    (0, 0b101001): lambda x, y: (x >> 1) | (x & SIGN),  # D>>1
+    (1, 0b101000): lambda x, y: (x * y) & MASK,  # D*M
+    (1, 0b101001): ext_div,  # D/M
+    (1, 0b101011): ext_mod,  # D%M
+}
@@ -1,3 +1,8 @@
+import mmap
+import struct
+import sys
+from array import array
+
 symbols = {
     "SP":0, "LCL":1, "ARG":2, "THIS":3, "THAT":4,
     "R0":0, "R1":1, "R2":2, "R3":3, "R4":4,
@@ -6,6 +11,9 @@ symbols = {
     "SCREEN":16384, "KBD":24576
 }
 
+# Largest value an A-instruction holds; bit 15 is the opcode
+MAX_ADDRESS = (1 << 15) - 1
+
 print_table = {
     "PRINT":"01", "PRINT_CHAR":"10", "NO_PRINT":"11"
 }
@@ -23,6 +31,17 @@ comp_table = {
     "D|A":"0010101", "D|M":"1010101"
 }
 
+# Extended instruction set (--isa=extended): native shift, multiply, divide
+# and remainder on comp codes the Hack ALU does not use. See alu.ext_ops for
+# what they compute.
+ext_comp_table = {
+    "D<<1":"0101000", "D>>1":"0101001",
+    "D*M":"1101000", "D/M":"1101001", "D%M":"1101011"
+}
+
+# isa -> the comp mnemonics it accepts
+comp_tables = {"hack": comp_table, "extended": {**comp_table, **ext_comp_table}}
+
 dest_table = {
     None:"000", "M":"001", "D":"010", "MD":"011", "A":"100", "AM":"101", "AD":"110", "AMD":"111"
 }
@@ -32,17 +51,83 @@ jump_table = {
     "JLT":"100", "JNE":"101", "JLE":"110", "JMP":"111"
 }
 
-def assemble(asm_code):
+def split_word(word):
+    """Split a ROM word into its fields.
+
+    word is an int or a 16-character bit string as produced by assemble().
+    Returns ``("a", value)`` or
+    ``("c", print_bits, a_bit, comp_bits, dest_bits, jump_bits)``, all ints;
+    comp_bits holds zx,nx,zy,ny,f,no from most to least significant bit.
+    """
+    if isinstance(word, str):
+        word = int(word, 2)
+    if not 0 <= word <= 0xFFFF:
+        # An A-word whose value spilled into bit 16 and up; read as 16 bits
+        # it would be a C-instruction.
+        raise ValueError(f"ROM word {word:#x} does not fit 16 bits")
+    if not word & 0x8000:
+        return ("a", word)
+    return ("c", (word >> 13) & 0b11, (word >> 12) & 1, (word >> 6) & 0b111111,
+            (word >> 3) & 0b111, word & 0b111)
+
+def parse_line(line):
+    """Split one line of assembly (comments already stripped) into fields.
+
+    Returns ``("label", name)``, ``("a", symbol)`` or
+    ``("c", print, dest, comp, jump)`` with print one of the print_table
+    keys and dest/jump None when absent.
+    """
+    if line.startswith("(") and line.endswith(")"):
+        return ("label", line[1:-1])
+    if line.startswith("@"):
+        return ("a", line[1:])
+    if line.startswith("PRINT") or line.startswith("PRINT_CHAR"):
+        prnt, expr = line.split(" ", maxsplit=1)
+        prnt = prnt.strip()
+        expr = expr.strip()
+    else:
+        prnt = "NO_PRINT"
+        expr = line
+    if "=" in expr:
+        dest, comp_jump = expr.split("=")
+        dest = dest.strip()
+    else:
+        dest = None
+        comp_jump = expr
+    if ";" in comp_jump:
+        comp, jump = comp_jump.split(";")
+        comp = comp.strip()
+        jump = jump.strip()
+    else:
+        comp = comp_jump.strip()
+        jump = None
+    return ("c", prnt, dest, comp, jump)
+
+def format_line(instr):
+    """Inverse of parse_line."""
+    if instr[0] == "label":
+        return f"({instr[1]})"
+    if instr[0] == "a":
+        return f"@{instr[1]}"
+    _, prnt, dest, comp, jump = instr
+    line = comp if dest is None else f"{dest}={comp}"
+    if jump is not None:
+        line = f"{line};{jump}"
+    if prnt != "NO_PRINT":
+        line = f"{prnt} {line}"
+    return line
+
+def assemble(asm_code, with_labels=False, isa="hack"):
     lines = [line.split("//")[0].strip() for line in asm_code.split("\n")]
     lines = [line for line in lines if not line.startswith("//")]
-    lines = [line for line in lines if line.strip() != ""]
+    lines = [parse_line(line) for line in lines if line.strip() != ""]
 
     #1st pass: get all the labels
     rom_address = 0
     labels = {}
     for line in lines:
-        if line.startswith("(") and line.endswith(")"):
-            labels[line[1:-1]] = rom_address
+        if line[0] == "label":
+            labels[line[1]] = rom_address
         else:
             rom_address += 1
 
@@ -51,11 +136,11 @@ def assemble(asm_code):
     output = []
 
     for line in lines:
-        if line.startswith("("):
+        if line[0] == "label":
             continue
 
-        if line.startswith("@"):
-            symbol = line[1:]
+        if line[0] == "a":
+            symbol = line[1]
 
             if symbol.isdigit():
                 addr = int(symbol)
@@ -67,37 +152,152 @@ def assemble(asm_code):
                 symbols[symbol] = nvar
                 addr = nvar
                 nvar += 1
+            if addr > MAX_ADDRESS:
+                raise ValueError(f"@{symbol} does not fit an A-instruction (15 bits)")
             output.append(f"0{addr:015b}")
         else:
-            if line.startswith("PRINT") or line.startswith("PRINT_CHAR"):
-                prnt, expr = line.split(" ", maxsplit=1)
-                prnt  =prnt.strip()
-                expr = expr.strip()
-            else:
-                prnt = "NO_PRINT"
-                expr = line
-            if "=" in expr:
-                dest, comp_jump = line.split("=")
-                dest = dest.strip()
-            else:
-                dest = None
-                comp_jump = expr
-            if ";" in comp_jump:
-                comp, jump = comp_jump.split(";")
-                comp = comp.strip()
-                jump = jump.strip()
-            else:
-                comp = comp_jump.strip()
-                jump = None
-
+            _, prnt, dest, comp, jump = line
             print_bits = print_table[prnt]
-            comp_bits = comp_table[comp]
+            comp_bits = comp_tables[isa][comp]
             dest_bits = dest_table[dest]
             jump_bits = jump_table[jump]
             code = f"1{print_bits}{comp_bits}{dest_bits}{jump_bits}"
             output.append(code)
+    if with_labels:
+        return output, labels
     return output
 
+# isa -> parsed C-instruction -> ROM word
+c_words = {isa: {} for isa in comp_tables}
+
+def encode_c(instr, isa="hack"):
+    words = c_words[isa]
+    word = words.get(instr)
+    if word is None:
+        _, prnt, dest, comp, jump = instr
+        word = words[instr] = int(
+            f"1{print_table[prnt]}{comp_tables[isa][comp]}{dest_table[dest]}{jump_table[jump]}", 2)
+    return word
+
+def encode(instrs, with_labels=False, isa="hack"):
+    """Encode structured instructions straight to ROM words (ints).
+
+    instrs are in the form parse_line returns, except that A-instruction
+    values may already be ints; anything else must be a label or one of
+    `symbols`. Label references are patched in one pass at the end.
+    """
+    rom = []
+    labels = {}
+    fixups = []
+    for instr in instrs:
+        kind = instr[0]
+        if kind == "c":
+            rom.append(encode_c(instr, isa))
+        elif kind == "a":
+            if isinstance(instr[1], int):
+                if not 0 <= instr[1] <= MAX_ADDRESS:
+                    raise ValueError(f"@{instr[1]} does not fit an A-instruction (15 bits)")
+                rom.append(instr[1])
+            else:
+                fixups.append((len(rom), instr[1]))
+                rom.append(0)
+        else:
+            labels[instr[1]] = len(rom)
+    for address, symbol in fixups:
+        if symbol in labels:
+            rom[address] = labels[symbol]
+        elif symbol in symbols:
+            rom[address] = symbols[symbol]
+        else:
+            raise ValueError(f"Undefined label {symbol!r}")
+        if rom[address] > MAX_ADDRESS:
+            raise ValueError(f"@{symbol} = {rom[address]} does not fit an A-instruction (15 bits); "
+                             f"the program is too large")
+    if with_labels:
+        return rom, labels
+    return rom
+
+# Binary ROM image: a 12-byte header (magic, format version, flags, word
+# count) followed by every ROM word as a little-endian uint16. With the
+# IMAGE_RAM flag the words are followed by the initial RAM: a uint32 count,
+# then that many (uint32 address, uint64 value) pairs.
+IMAGE_MAGIC = b"LAVA"
+IMAGE_VERSION = 1
+IMAGE_HEADER = struct.Struct("<4sHHI")
+IMAGE_EXTENDED = 0x1  # flag: the ROM uses the extended instruction set
+IMAGE_RAM = 0x2  # flag: an initial RAM section follows the ROM
+IMAGE_RAM_COUNT = struct.Struct("<I")
+IMAGE_RAM_WORD = struct.Struct("<IQ")
+
+def pack_image(rom, isa="hack", ram_init=None):
+    """Encode a ROM (bit strings or ints), and the initial RAM it needs
+    ({address: value}), as image bytes."""
+    words = array("H", (int(word, 2) if isinstance(word, str) else word for word in rom))
+    if sys.byteorder == "big":
+        words.byteswap()
+    flags = IMAGE_EXTENDED if isa == "extended" else 0
+    parts = [None, words.tobytes()]
+    if ram_init:
+        flags |= IMAGE_RAM
+        parts.append(IMAGE_RAM_COUNT.pack(len(ram_init)))
+        parts.extend(IMAGE_RAM_WORD.pack(address, value) for address, value in sorted(ram_init.items()))
+    parts[0] = IMAGE_HEADER.pack(IMAGE_MAGIC, IMAGE_VERSION, flags, len(words))
+    return b"".join(parts)
+
+def write_image(rom, path, isa="hack", ram_init=None):
+    with open(path, "wb") as f:
+        f.write(pack_image(rom, isa, ram_init))
+
+def image_info(data):
+    """Return ``(isa, ram_init)`` for the image in data (bytes or an mmap):
+    the instruction set it was built for and its initial RAM."""
+    _, _, flags, count = IMAGE_HEADER.unpack_from(data)
+    isa = "extended" if flags & IMAGE_EXTENDED else "hack"
+    ram_init = {}
+    if flags & IMAGE_RAM:
+        offset = IMAGE_HEADER.size + 2 * count
+        if len(data) < offset + IMAGE_RAM_COUNT.size:
+            raise ValueError("Truncated ROM image")
+        (entries,) = IMAGE_RAM_COUNT.unpack_from(data, offset)
+        offset += IMAGE_RAM_COUNT.size
+        if len(data) < offset + entries * IMAGE_RAM_WORD.size:
+            raise ValueError("Truncated ROM image")
+        for _ in range(entries):
+            address, value = IMAGE_RAM_WORD.unpack_from(data, offset)
+            ram_init[address] = value
+            offset += IMAGE_RAM_WORD.size
+    return isa, ram_init
+
+def unpack_image(data):
+    """Return the ROM words in image bytes (or an mmap) as a sequence of ints.
+
+    On little-endian machines this is a zero-copy memoryview over data."""
+    if len(data) < IMAGE_HEADER.size:
+        raise ValueError("Not a LavaScript ROM image: file too short")
+    magic, version, _flags, count = IMAGE_HEADER.unpack_from(data)
+    if magic != IMAGE_MAGIC:
+        raise ValueError("Not a LavaScript ROM image: bad magic")
+    if version != IMAGE_VERSION:
+        raise ValueError(f"Unsupported ROM image version {version}")
+    end = IMAGE_HEADER.size + 2 * count
+    if len(data) < end:
+        raise ValueError("Truncated ROM image")
+    if sys.byteorder == "big":
+        words = array("H", bytes(data[IMAGE_HEADER.size:end]))
+        words.byteswap()
+        return words
+    return memoryview(data)[IMAGE_HEADER.size:end].cast("H")
+
+def read_image(path, with_info=False):
+    """Map an image file into memory and return its ROM words (and, with
+    with_info, the instruction set and initial RAM from image_info)."""
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    words = unpack_image(mapped)
+    if with_info:
+        return (words,) + image_info(mapped)
+    return words
+
 if __name__ == "__main__":
     with open("prog.asm") as f:
         asm_code = f.read()
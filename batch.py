@@ -0,0 +1,137 @@
+# Batch mode for melt: compile and run many programs on a process pool.
+#
+# The parent expands the file list and looks every source up in the compile
+# cache. Hits (and .lava images) travel to the workers as packed image bytes
+# (assembler.pack_image), which is two bytes per instruction; misses travel
+# as source text and are compiled, and cached, by the worker. Each worker runs
+# its program with CaptureSink output under a step budget and a wall-clock
+# timeout and returns one summary record, which the parent writes as a JSON
+# line as soon as it arrives.
+
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from assembler import image_info, pack_image, unpack_image
+from cache import CompileCache, cacheable, isa_options
+from compiler import Compiler
+from cpu import CPU, HALTED, EXHAUSTED, ERROR
+from output import CaptureSink
+from parser import compile_source
+
+TIMEOUT = "timeout"  # status: the wall-clock limit ran out
+COMPILE_ERROR = "compile_error"  # status: the source did not compile
+
+# Instructions per run_for() call between budget and clock checks
+SLICE_STEPS = 10000
+
+def expand_paths(patterns):
+    """Expand glob patterns (for shells that did not) and keep plain paths."""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        paths.extend(matches)
+    return paths
+
+def make_job(path, use_cache=True, cache_dir=None, isa="hack"):
+    """The unit of work sent to a worker: a dict holding either the packed
+    ROM image or, when it still has to be compiled, the source."""
+    job = {"file": path, "image": None, "source": None, "cache_key": None, "isa": isa}
+    if path.endswith(".lava"):
+        with open(path, "rb") as f:
+            job["image"] = f.read()
+        return job
+    with open(path) as f:
+        source = f.read()
+    if use_cache and cacheable(source):
+        cache = CompileCache(cache_dir)
+        key = cache.key(source, isa_options(isa))
+        hit = cache.get(key)
+        if hit is not None:
+            job["image"] = pack_image(hit[0], isa, hit[2])
+            return job
+        else:
+            job["cache_key"] = key
+    job["source"] = source
+    return job
+
+def run_job(job, max_steps=None, timeout=None, engine="blocks", cache_dir=None):
+    """Compile (if needed) and run one job. Returns its summary record."""
+    start = time.monotonic()
+    deadline = None if timeout is None else start + timeout
+    result = {"file": job["file"], "status": None, "steps": 0, "wall_s": 0.0, "output": ""}
+    try:
+        if job["image"] is not None:
+            rom = unpack_image(job["image"])
+            isa, ram_init = image_info(job["image"])
+        else:
+            isa = job["isa"]
+            compiler = Compiler(isa=isa)
+            rom = compile_source(job["source"], compiler)
+            ram_init = compiler.ram_init
+            if job["cache_key"] is not None:
+                try:
+                    CompileCache(cache_dir).put(job["cache_key"], rom, compiler.labels, ram_init)
+                except OSError:
+                    pass
+    except Exception as e:
+        result.update(status=COMPILE_ERROR, error=f"{type(e).__name__}: {e}",
+                      wall_s=time.monotonic() - start)
+        return result
+
+    sink = CaptureSink()
+    try:
+        cpu = CPU(rom, engine=engine, output=sink, isa=isa, ram_init=ram_init)
+    except Exception as e:
+        # Such as an image whose initial RAM lies past the end of memory
+        result.update(status=ERROR, error=f"{type(e).__name__}: {e}",
+                      wall_s=time.monotonic() - start)
+        return result
+    status = EXHAUSTED
+    while True:
+        budget = SLICE_STEPS if max_steps is None else min(SLICE_STEPS, max_steps - cpu.steps)
+        if budget <= 0:
+            break
+        status = cpu.run_for(budget)
+        if status != EXHAUSTED:
+            break
+        if deadline is not None and time.monotonic() >= deadline:
+            status = TIMEOUT
+            break
+    result.update(status=status, steps=cpu.steps, wall_s=time.monotonic() - start,
+                  output=sink.getvalue().decode("latin-1"))
+    if status == ERROR:
+        result["error"] = f"{type(cpu.error).__name__}: {cpu.error}"
+    return result
+
+def run_batch(patterns, summary=None, workers=None, max_steps=None, timeout=None,
+              engine="blocks", use_cache=True, cache_dir=None, isa="hack"):
+    """Run every program matched by patterns on a pool of `workers` processes
+    (default: one per core), writing one JSON line per program to summary
+    (default: stdout) in completion order. Returns the number of programs
+    that did not halt cleanly. Sources are compiled for isa; .lava images
+    run with the instruction set they were built for."""
+    summary = summary or sys.stdout
+    paths = expand_paths(patterns)
+    failures = 0
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = {}
+        for path in paths:
+            try:
+                job = make_job(path, use_cache, cache_dir, isa)
+            except OSError as e:
+                failures += 1
+                summary.write(json.dumps({"file": path, "status": ERROR, "steps": 0, "wall_s": 0.0,
+                                          "output": "", "error": str(e)}) + "\n")
+                continue
+            futures[pool.submit(run_job, job, max_steps, timeout, engine, cache_dir)] = path
+        for future in as_completed(futures):
+            result = future.result()
+            if result["status"] != HALTED:
+                failures += 1
+            summary.write(json.dumps(result) + "\n")
+            summary.flush()
+    return failures
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# Compile and run throughput benchmarks.
+#
+# Every workload is timed stage by stage: parse (tokenize and build the
+# syntax tree), compile (code generation, runtime routines and the peephole
+# passes), assemble (encoding to ROM words), and run (CPU.run, output captured rather than printed).
+# Each stage reports the best of --repeat runs. ROMs past 32K words (the
+# default generated_large) cannot hold their jump targets in 15-bit
+# A-instructions, so only their parse and compile are timed. Results go to
+# stdout as a table, and with --json to a file that can be compared between
+# releases.
+#
+#     python benchmarks/bench.py
+#     python benchmarks/bench.py --engine blocks --json results.json counting arith
+
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from assembler import encode, MAX_ADDRESS
+from compiler import Compiler
+from cpu import CPU
+from lexer import tokenize
+from output import CaptureSink
+from parser import Parser, nesting_depth
+
+def generated_large(lines):
+    """Straight-line source of `lines` statements, with a short loop every
+    hundred lines so blocks and labels are exercised too."""
+    out = ["s = 1"]
+    for i in range(lines - 2):
+        if i % 100 == 99:
+            out.append(f"for (k = 0; k < 3; k++) {{ s = s + k * {i % 7 + 2} }}")
+        else:
+            out.append(f"v{i % 64} = {i % 1000} + s * {i % 5 + 2} - v{(i + 1) % 64}")
+    out.append("print(s, \\n)")
+    return "\n".join(out) + "\n"
+
+def generated_deep(depth):
+    """`depth` nested ifs and whiles around a single assignment."""
+    out = ["x = 0"]
+    for i in range(depth):
+        out.append(f"if x < {i + 1} {{" if i % 2 else f"while x < {i + 1} {{")
+    out.append("x = x + 1")
+    out.extend("}" * depth)
+    out.append("print(x, \\n)")
+    return "\n".join(out) + "\n"
+
+def workloads(large_lines, deep_depth):
+    """name -> source, for the .ls files next to this script plus the
+    generated sources."""
+    sources = {}
+    for path in sorted(glob.glob(os.path.join(HERE, "*.ls"))):
+        with open(path) as f:
+            sources[os.path.splitext(os.path.basename(path))[0]] = f.read()
+    sources["generated_large"] = generated_large(large_lines)
+    sources["generated_deep"] = generated_deep(deep_depth)
+    return sources
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+def bench_one(source, engine="interp", repeat=3, run=True, isa="hack"):
+    best = {}
+    steps = None
+    note = None
+    def record(stage, seconds):
+        best[stage] = min(best.get(stage, seconds), seconds)
+
+    old_limit = sys.getrecursionlimit()
+    for _ in range(repeat):
+        def parse_source():
+            tokens = tokenize(source)
+            sys.setrecursionlimit(max(old_limit, 1000 + 16 * nesting_depth(tokens)))
+            return Parser(tokens).parse_program()
+
+        try:
+            program, seconds = timed(parse_source)
+            record("parse", seconds)
+            compiler = Compiler(isa=isa)
+            def generate():
+                compiler.compile_program(program)
+                return compiler.finish()
+            asm, seconds = timed(generate)
+            record("compile", seconds)
+        finally:
+            sys.setrecursionlimit(old_limit)
+        rom_words = sum(1 for instr in asm if instr[0] != "label")
+        if rom_words > MAX_ADDRESS + 1:
+            note = f"{rom_words} ROM words do not fit 15-bit addresses; not assembled or run"
+            continue
+        (rom, _), seconds = timed(lambda: encode(asm, with_labels=True, isa=isa))
+        record("assemble", seconds)
+
+        if run:
+            cpu = CPU(rom, engine=engine, output=CaptureSink(), isa=isa, ram_init=compiler.ram_init)
+            _, seconds = timed(cpu.run)
+            record("run", seconds)
+            steps = cpu.steps
+
+    result = {
+        "source_lines": source.count("\n"),
+        "rom_words": rom_words,
+        "data_words": compiler.data_words(),  # variables and temporaries
+        "peephole_removed": compiler.peephole_removed,
+        "parse_s": best["parse"],
+        "compile_s": best["compile"],
+    }
+    if note is not None:
+        result["note"] = note
+    else:
+        result["assemble_s"] = best["assemble"]
+    if steps is not None:
+        result["run_s"] = best["run"]
+        result["steps"] = steps
+        result["steps_per_s"] = steps / best["run"] if best["run"] else None
+    return result
+
+def main(argv=None):
+    arg_parser = argparse.ArgumentParser(description="Benchmark LavaScript compile and run throughput.")
+    arg_parser.add_argument("names", nargs="*", help="workloads to run (default: all)")
+    arg_parser.add_argument("--engine", default="interp", choices=("interp", "blocks"),
+                            help="CPU engine used for the run stage")
+    arg_parser.add_argument("--isa", default="hack", choices=("hack", "extended"),
+                            help="instruction set to compile for")
+    arg_parser.add_argument("--repeat", type=int, default=3,
+                            help="runs per workload; the best time of each stage is kept")
+    arg_parser.add_argument("--no-run", action="store_true",
+                            help="only time parse, compile and assemble")
+    arg_parser.add_argument("--large-lines", type=int, default=50000,
+                            help="size of the generated_large source (past about 1500 lines "
+                                 "its ROM is too big to assemble, and only parse and compile "
+                                 "are timed)")
+    arg_parser.add_argument("--deep-depth", type=int, default=2000,
+                            help="nesting depth of the generated_deep source")
+    arg_parser.add_argument("--json", default=None, help="also write the results to this file")
+    args = arg_parser.parse_args(argv)
+
+    sources = workloads(args.large_lines, args.deep_depth)
+    names = args.names or list(sources)
+    for name in names:
+        if name not in sources:
+            arg_parser.error(f"unknown workload {name!r} (have: {', '.join(sources)})")
+
+    results = {}
+    print(f"{'workload':<16} {'lines':>7} {'words':>8} {'data':>6} {'peep':>6} {'parse':>8} {'compile':>8} "
+          f"{'assemble':>8} {'run':>8} {'steps':>10} {'steps/s':>10}")
+    for name in names:
+        r = results[name] = bench_one(sources[name], args.engine, args.repeat, not args.no_run, args.isa)
+        assemble_col = f"{r['assemble_s']:8.3f}" if "assemble_s" in r else f"{'-':>8}"
+        run_cols = (f"{r['run_s']:8.3f} {r['steps']:10d} {r['steps_per_s']:10.0f}"
+                    if "run_s" in r else f"{'-':>8} {'-':>10} {'-':>10}")
+        print(f"{name:<16} {r['source_lines']:7d} {r['rom_words']:8d} {r['data_words']:6d} "
+              f"{r['peephole_removed']:6d} {r['parse_s']:8.3f} "
+              f"{r['compile_s']:8.3f} {assemble_col} {run_cols}", flush=True)
+        if "note" in r:
+            print(f"  {name}: {r['note']}", flush=True)
+
+    if args.json:
+        report = {
+            "python": platform.python_version(),
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "engine": args.engine,
+            "isa": args.isa,
+            "repeat": args.repeat,
+            "results": results,
+        }
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+if __name__ == "__main__":
+    main()
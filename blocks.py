@@ -0,0 +1,135 @@
+# Basic-block translator for the "blocks" CPU engine.
+#
+# The ROM is cut into straight-line runs of instructions that end at a jump
+# (or just before another block's first instruction). Each run is turned into
+# Python source for one function that keeps A and D in locals, so the CPU
+# pays one Python call per block instead of one dispatch per instruction:
+#
+#     def block_12(A, D, ram, written, emit):
+#         A = 7
+#         D = ram[A]
+#         ...
+#         if D == 0: return A, D, A
+#         return A, D, 19
+#
+# Blocks are translated lazily the first time execution reaches their start
+# address, so computed jump targets (return addresses loaded with D=A) work
+# without any whole-program analysis.
+
+from alu import alu_fn, ext_div, ext_mod, MASK, SIGN
+from assembler import split_word
+
+# jump_bits -> Python condition on D, or None for "never jumps"
+jump_conditions = {
+    0b000: None,
+    0b001: "0 < D < SIGN",          # JGT
+    0b010: "D == 0",                # JEQ
+    0b011: "D < SIGN",              # JGE
+    0b100: "D >= SIGN",             # JLT
+    0b101: "D != 0",                # JNE
+    0b110: "D == 0 or D >= SIGN",   # JLE
+    0b111: "True",                  # JMP
+}
+
+# (a_bit, comp_bits) -> Python expression for the extended ISA's comps
+ext_exprs = {
+    (0, 0b101000): "((D << 1) & MASK)",
+    (0, 0b101001): "((D >> 1) | (D & SIGN))",
+    (1, 0b101000): "((D * ram[A]) & MASK)",
+    (1, 0b101001): "ext_div(D, ram[A])",
+    (1, 0b101011): "ext_mod(D, ram[A])",
+}
+
+def comp_expr(comp_bits, a_bit, isa="hack"):
+    """Return a Python expression for the ALU output of one C-instruction."""
+    if isa == "extended" and (a_bit, comp_bits) in ext_exprs:
+        return ext_exprs[a_bit, comp_bits]
+    zx, nx, zy, ny, f, no = [(comp_bits >> shift) & 1 for shift in range(5, -1, -1)]
+    if zx and zy:
+        # Both inputs are constants, so is the result.
+        return str(alu_fn(zx, nx, zy, ny, f, no)(0, 0))
+
+    def operand(name, zero, negate):
+        if zero:
+            return "MASK" if negate else "0"
+        return f"({name} ^ MASK)" if negate else name
+
+    x = operand("D", zx, nx)
+    y = operand("ram[A]" if a_bit else "A", zy, ny)
+    if f:
+        out = f"(({x} + {y}) & MASK)"
+    else:
+        out = f"({x} & {y})"
+    return f"({out} ^ MASK)" if no else out
+
+def find_leaders(rom):
+    """Addresses that start a block: 0, every static jump target, and every
+    instruction that follows a jump."""
+    leaders = {0}
+    prev = None
+    for pc, word in enumerate(rom):
+        fields = split_word(word)
+        if fields[0] == "c" and fields[5]:
+            leaders.add(pc + 1)
+            if prev is not None and prev[0] == "a":
+                leaders.add(prev[1])
+        prev = fields
+    return leaders
+
+def block_source(rom, start, leaders, isa="hack"):
+    """Generate the source of the block starting at `start`.
+
+    Returns ``(source, length)``.
+    """
+    lines = [f"def block_{start}(A, D, ram, written, emit):"]
+    pc = start
+    while pc < len(rom):
+        fields = split_word(rom[pc])
+        if fields[0] == "a":
+            lines.append(f"    A = {fields[1]}")
+        else:
+            _, print_bits, a_bit, comp_bits, dest_bits, jump_bits = fields
+            jump = jump_conditions[jump_bits]
+            value = comp_expr(comp_bits, a_bit, isa)
+            if dest_bits == 0b000:
+                # Nothing stored; the value only matters if it is printed or
+                # tested, and both of those read D, not the ALU output.
+                pass
+            elif dest_bits in (0b010, 0b100):
+                lines.append(f"    {'D' if dest_bits == 0b010 else 'A'} = {value}")
+            else:
+                lines.append(f"    v = {value}")
+                if dest_bits & 0b001:
+                    lines.append("    ram[A] = v")
+                    lines.append("    written[A >> 3] |= 1 << (A & 7)")
+                if dest_bits & 0b010:
+                    lines.append("    D = v")
+                if dest_bits & 0b100:
+                    lines.append("    A = v")
+            if print_bits == 0b01:
+                lines.append("    emit(str(D - (1 << 64) if D & SIGN else D))")
+            elif print_bits == 0b10:
+                lines.append("    emit(chr(D & 0xFF))")
+            if jump == "True":
+                lines.append("    return A, D, A")
+                pc += 1
+                break
+            if jump is not None:
+                lines.append(f"    if {jump}: return A, D, A")
+                pc += 1
+                break
+        pc += 1
+        if pc in leaders:
+            break
+    lines.append(f"    return A, D, {pc}")
+    return "\n".join(lines) + "\n", pc - start
+
+def translate_block(rom, start, leaders, isa="hack"):
+    """Compile the block starting at `start` into a function.
+
+    Returns ``(function, length)``.
+    """
+    source, length = block_source(rom, start, leaders, isa)
+    namespace = {"MASK": MASK, "SIGN": SIGN, "ext_div": ext_div, "ext_mod": ext_mod}
+    exec(compile(source, f"<block {start}>", "exec"), namespace)
+    return namespace[f"block_{start}"], length
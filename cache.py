@@ -0,0 +1,124 @@
+# On-disk cache of compiled programs for the melt launcher.
+#
+# Entries are content-addressed: the key is a hash of the source text, the
+# compiler options and the toolchain itself (the source of every module that
+# takes part in compiling), so editing the compiler invalidates old entries
+# without anyone having to bump a version number. Each entry stores the
+# assembled ROM, the label map and the initial RAM (the constant pool).
+
+import hashlib
+import json
+import os
+import tempfile
+
+from lexer import tokenize
+
+# Modules whose code decides what a source file compiles to.
+TOOLCHAIN = ("lexer.py", "parser.py", "nodes.py", "compiler.py", "optimizer.py", "loops.py", "peephole.py", "assembler.py")
+
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+def default_cache_dir():
+    if os.environ.get("LAVASCRIPT_CACHE_DIR"):
+        return os.environ["LAVASCRIPT_CACHE_DIR"]
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "lavascript")
+
+_toolchain_version = None
+
+def toolchain_version():
+    global _toolchain_version
+    if _toolchain_version is None:
+        digest = hashlib.sha256()
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in TOOLCHAIN:
+            with open(os.path.join(here, name), "rb") as f:
+                digest.update(name.encode() + b"\0" + f.read() + b"\0")
+        _toolchain_version = digest.hexdigest()
+    return _toolchain_version
+
+def cacheable(source):
+    """False for programs that must be compiled afresh on every run: Maybe
+    is decided at compile time, so a cached ROM would always take the same
+    branch. Sources that do not tokenize are left to the compiler to report."""
+    try:
+        return not any(kind == "name" and value == "Maybe" for kind, value, _, _ in tokenize(source))
+    except SyntaxError:
+        return False
+
+def isa_options(isa):
+    """The key options for a compile that targets isa. Hack builds use no
+    options, so their entries stay valid."""
+    return "" if isa == "hack" else f"isa={isa}"
+
+class CompileCache:
+    def __init__(self, directory=None, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+
+    def key(self, source, options=""):
+        digest = hashlib.sha256()
+        for part in (toolchain_version(), options, source):
+            digest.update(part.encode() + b"\0")
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        """Return ``(rom, labels, ram_init)`` for key, or None on a miss."""
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(path)  # eviction is least-recently-used
+        except OSError:
+            pass
+        return entry["rom"], entry["labels"], {address: value for address, value in entry["ram"]}
+
+    def put(self, key, rom, labels, ram_init=None):
+        os.makedirs(self.directory, exist_ok=True)
+        entry = {"rom": [int(word, 2) if isinstance(word, str) else word for word in rom],
+                 "labels": labels,
+                 "ram": sorted((ram_init or {}).items())}
+        # Write to a temporary file in the same directory and rename it into
+        # place, so readers never see a half-written entry.
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(entry, f, separators=(",", ":"))
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        self.evict()
+
+    def evict(self):
+        """Delete least-recently-used entries until the cache fits max_bytes."""
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
@@ -1,50 +1,256 @@
 import itertools
-from assembler import assemble
-import re
+from assembler import encode, format_line, parse_line
+from peephole import optimize, PASSES
+from optimizer import fold, fold_condition, is_literal
+from alu import MASK
+from loops import optimize_loop
+from runtime import write_div, write_mul
+
+# Variables start above R0-R15. R13-R15 are the scratch registers of the
+# runtime routines, and the rest are kept free as in the Hack convention.
+VAR_BASE = 16
+
+# C-instruction text -> parsed instruction, shared by every Compiler
+c_instructions = {}
 
 class Compiler:
-    def __init__(self):
-        self.vars_map = {}
-        self.next_ram = 1
+    def __init__(self, peephole=True, loops=True, isa="hack"):
+        self.vars_map = {}  # variables and routine slots, live for the whole program
+        self.temps = {}  # expression temporaries currently live -> address
+        self.free_slots = []  # addresses of temporaries that have been freed
+        self.temp_count = itertools.count(1)
+        self.next_ram = VAR_BASE
+        # The program as structured instructions (see assembler.encode):
+        # ("label", name), ("a", int or symbol), ("c", print, dest, comp, jump)
         self.asm = []
         self.label_count = itertools.count()
+        self.runtime = []  # shared routines (see call_runtime) the program calls
+        # (left, right) operands whose quotient and remainder are still in
+        # R13/R15 from the last DIV call, so a following / or % can skip it.
+        self.divmod_operands = None
+        # peephole: True runs every pass in peephole.PASSES, False none, or
+        # give the names of the passes to run. compile() records how many
+        # instructions they removed in peephole_removed.
+        self.peephole = PASSES if peephole is True else (peephole or ())
+        self.peephole_removed = 0
+        self.loops = loops  # run the loop pass in loops.py
+        self.loop_vars = itertools.count(1)
+        # isa="extended" uses the native D<<1, D*M, D/M and D%M comps
+        # (assembler.ext_comp_table) instead of the MUL and DIV routines.
+        self.isa = isa
+        # Constants an A-instruction cannot hold (see constant()): value ->
+        # slot name. finish() puts the slots in one block after the other
+        # data, and ram_init maps each address to the value the CPU must
+        # load there before the program starts.
+        self.constants = {}
+        self.constant_slots = set()
+        self.ram_init = {}
+        self.labels = {}  # label -> ROM address, filled in by compile()
+        self.line = None  # source line of the statement being compiled
+        self.label_lines = {}  # label -> source line it was emitted for
 
     def get_var_addr(self, var):
+        if var in self.temps:
+            return self.temps[var]
+        if var in self.constant_slots:
+            return var  # replaced by its address in finish()
         if var not in self.vars_map:
+            # Always a fresh slot: a variable read before it is assigned must
+            # see 0, not whatever a temporary left behind.
             self.vars_map[var] = self.next_ram
             self.next_ram += 1
         return self.vars_map[var]
 
+    def constant(self, value):
+        # Operand for an int: the int itself if an A-instruction can load it,
+        # else the name of its slot in the constant pool.
+        if not isinstance(value, int):
+            return value
+        value &= MASK
+        if is_literal(value):
+            return value
+        if value not in self.constants:
+            self.constants[value] = f"__const{len(self.constants)}"
+            self.constant_slots.add(self.constants[value])
+        return self.constants[value]
+
+    def loop_var(self):
+        # A variable the loop pass keeps a hoisted value in.
+        return f"__loop{next(self.loop_vars)}"
+
+    def alloc_temp(self):
+        # Temporaries reuse the slots of ones that are no longer live.
+        name = f"__tmp{next(self.temp_count)}"
+        if self.free_slots:
+            self.temps[name] = self.free_slots.pop()
+        else:
+            self.temps[name] = self.next_ram
+            self.next_ram += 1
+        return name
+
+    def is_temp(self, name):
+        return name in self.temps
+
+    def free_temp(self, name):
+        # Ignores anything that is not a live temporary (variables, ints).
+        if name in self.temps:
+            self.free_slots.append(self.temps.pop(name))
+
+    def data_words(self):
+        # Peak data memory: every slot ever handed out is live at some point,
+        # and temporaries are only added when no freed slot is available.
+        return self.next_ram - VAR_BASE
+
     def write(self, line):
-        self.asm.append(line)
+        # One C-instruction, e.g. "D=D+M" or "PRINT D". Each distinct line is
+        # only parsed once.
+        instr = c_instructions.get(line)
+        if instr is None:
+            instr = c_instructions[line] = parse_line(line)
+        self.asm.append(instr)
+
+    def load(self, value):
+        # A-instruction: an int, a label or a predefined symbol such as R13.
+        self.asm.append(("a", value))
+
+    def label(self, name):
+        # Code after a label can be reached from elsewhere.
+        self.divmod_operands = None
+        if self.line is not None:
+            self.label_lines[name] = self.line
+        self.asm.append(("label", name))
+
+    def forget_divmod(self, addr):
+        # A store to addr invalidates a cached division that read it.
+        if self.divmod_operands and ("var", addr) in self.divmod_operands:
+            self.divmod_operands = None
+
+    def call_runtime(self, name):
+        # Jump to a shared routine, leaving the return address in its
+        # __<name>_ret slot. The routine is emitted once, by compile().
+        self.divmod_operands = None  # every routine uses R13-R15
+        ret_label = f"{name}_RET{next(self.label_count)}"
+        self.load(ret_label)
+        self.write("D=A")
+        self.load(self.get_var_addr(f'__{name.lower()}_ret'))
+        self.write("M=D")
+        self.load(name)
+        self.write("0;JMP")
+        self.label(ret_label)
+        if name not in self.runtime:
+            self.runtime.append(name)
+
+    def write_mul_routine(self):
+        write_mul(self)
 
     def compile_assign(self,var,expr):
+        expr = self.constant(expr)
         addr = self.get_var_addr(var)
         if isinstance(expr,int):
-            self.write(f"@{expr}")
+            self.load(expr)
             self.write("D=A")
         else:
             epxr_addr = self.get_var_addr(expr)
-            self.write(f"@{epxr_addr}")
+            self.load(epxr_addr)
             self.write("D=M")
-        self.write(f"@{addr}")
+        self.load(addr)
         self.write("M=D")
+        self.forget_divmod(addr)
 
-    def compile_math(self, dest, left, op, right):
+    def write_div_routine(self):
+        write_div(self)
+
+    def compile_expr(self, node, dest=None):
+        """Emit code for an expression tree and return the operand (variable
+        name or int) that holds its value. When dest is given the result ends
+        up there; otherwise it is a temporary the caller must free once it has
+        used it."""
+        if not isinstance(node, tuple):
+            return self.constant(node)
+        op, left, right = node
+        left = self.compile_expr(left)
+        if op == "<<":
+            # left * 2**right as repeated doubling
+            if dest is None:
+                dest = left if self.is_temp(left) else self.alloc_temp()
+            if self.isa == "extended":
+                self.compile_shift(dest, left, right)
+            else:
+                self.compile_math(dest, left, "+", left)
+                for _ in range(right - 1):
+                    self.compile_math(dest, dest, "+", dest)
+            if left != dest:
+                self.free_temp(left)
+            return dest
+        right = self.compile_expr(right)
+        if dest is None:
+            # Operands are loaded before dest is stored, so a temporary operand
+            # can hold the result itself.
+            if self.is_temp(left):
+                dest = left
+            elif self.is_temp(right):
+                dest = right
+            else:
+                dest = self.alloc_temp()
+        self.compile_math(dest, left, op, right)
+        for operand in (left, right):
+            if operand != dest:
+                self.free_temp(operand)
+        return dest
+
+    def compile_shift(self, dest, left, count):
+        # Extended ISA: dest = left * 2**count with one D<<1 per doubling.
+        if isinstance(left, int):
+            self.load(left)
+            self.write("D=A")
+        else:
+            self.load(self.get_var_addr(left))
+            self.write("D=M")
+        for _ in range(count):
+            self.write("D=D<<1")
+        dest_addr = self.get_var_addr(dest)
+        self.load(dest_addr)
+        self.write("M=D")
+        self.forget_divmod(dest_addr)
+
+    def compile_native_math(self, dest, left, op, right):
+        # Extended ISA: *, / and % are one instruction, D*M, D/M or D%M. The
+        # right operand has to be in memory, so a constant goes through R14.
+        if isinstance(right, int):
+            self.load(right)
+            self.write("D=A")
+            right_addr = "R14"
+            self.load(right_addr)
+            self.write("M=D")
+        else:
+            right_addr = self.get_var_addr(right)
+        if isinstance(left, int):
+            self.load(left)
+            self.write("D=A")
+        else:
+            self.load(self.get_var_addr(left))
+            self.write("D=M")
+        self.load(right_addr)
+        self.write(f"D=D{op}M")
         dest_addr = self.get_var_addr(dest)
+        self.load(dest_addr)
+        self.write("M=D")
+        self.forget_divmod(dest_addr)
 
-        # Save original values and types BEFORE any conversion
-        left_is_int = isinstance(left, int)
-        right_is_int = isinstance(right, int)
-        original_left = left
-        original_right = right
+    def compile_math(self, dest, left, op, right):
+        if self.isa == "extended" and op in ("*", "/", "%"):
+            self.compile_native_math(dest, left, op, right)
+            return
+        dest_addr = self.get_var_addr(dest)
 
         if isinstance(left, int):
-            self.write(f"@{left}")
+            left_key = ("int", left)
+            self.load(left)
             self.write("D=A")
         else:
             left_addr = self.get_var_addr(left)
-            self.write(f"@{left_addr}")
+            left_key = ("var", left_addr)
+            self.load(left_addr)
             self.write("D=M")
 
         not_int = False
@@ -53,262 +259,265 @@ class Compiler:
             not_int = True
 
         if op == '+':
-            self.write(f"@{right}")
+            self.load(right)
             self.write("D=D+M" if not_int else "D=D+A")
         elif op == '-':
-            self.write(f"@{right}")
+            self.load(right)
             self.write("D=D-M" if not_int else "D=D-A")
         elif op == '&':
-            self.write(f"@{right}")
+            self.load(right)
             self.write("D=D&M" if not_int else "D=D&A")
         elif op == '|':
-            self.write(f"@{right}")
+            self.load(right)
             self.write("D=D|M" if not_int else "D=D|A")
         elif op == "*":
-            # Optimize: use minimum value as counter if both are constants
-            if left_is_int and right_is_int:
-                counter, addend = (original_left, original_right) if original_left <= original_right else (
-                    original_right, original_left)
-                self.write(f"@{counter}")
-                self.write("D=A")
-                self.write("@R13")
-                self.write("M=D")  # counter
-                self.write("@0")
-                self.write("D=A")
-                self.write("@R14")
-                self.write("M=D")  # result = 0
-            else:
-                # At least one is a variable - need runtime comparison
-                # D already has left value loaded
-                self.write("@R13")
-                self.write("M=D")  # R13 = left
-                self.write(f"@{right}")
+            # D already has left value loaded
+            self.load("R13")
+            self.write("M=D")  # R13 = left
+            self.load(right)
+            self.write("D=M" if not_int else "D=A")
+            self.load("R14")
+            self.write("M=D")  # R14 = right
+            self.call_runtime("MUL")  # D = R13 * R14
+        elif op in ("/", "%"):
+            operands = (left_key, ("var", right) if not_int else ("int", right))
+            if self.divmod_operands != operands:
+                self.load("R13")
+                self.write("M=D")  # R13 = dividend
+                self.load(right)
                 self.write("D=M" if not_int else "D=A")
-                self.write("@R15")
-                self.write("M=D")  # R15 = right
-
-                # Compare and swap if needed to minimize loop iterations
-                self.write("@R13")
-                self.write("D=M")
-                self.write("@R15")
-                self.write("D=D-M")  # D = left - right
-                skip_swap = f"MUL_SKIP{next(self.label_count)}"
-                self.write(f"@{skip_swap}")
-                self.write("D;JLE")  # if left <= right, no swap needed
-
-                # Swap: R13 and R15
-                self.write("@R13")
-                self.write("D=M")
-                self.write("@R14")
-                self.write("M=D")  # temp = R13
-                self.write("@R15")
-                self.write("D=M")
-                self.write("@R13")
-                self.write("M=D")  # R13 = R15
-                self.write("@R14")
-                self.write("D=M")
-                self.write("@R15")
-                self.write("M=D")  # R15 = temp
-
-                self.write(f"({skip_swap})")  # Now R13 = min (counter), R15 = max (addend)
-                self.write("@0")
-                self.write("D=A")
-                self.write("@R14")
-                self.write("M=D")  # result = 0
-
-            # Main multiplication loop
-            loop = f"MUL_LOOP{next(self.label_count)}"
-            end = f"MUL_END{next(self.label_count)}"
-            self.write(f"({loop})")
-            self.write("@R13")
-            self.write("D=M")
-            self.write(f"@{end}")
-            self.write("D;JEQ")  # if counter == 0, end
-
-            # Add addend to result
-            if left_is_int and right_is_int:
-                # Compile-time: load constant addend
-                self.write(f"@{addend}")
-                self.write("D=A")
-            else:
-                # Runtime: load from R15
-                self.write("@R15")
-                self.write("D=M")
-            self.write("@R14")
-            self.write("M=D+M")
-
-            self.write("@R13")
-            self.write("M=M-1")  # counter--
-            self.write(f"@{loop}")
-            self.write("0;JMP")
-
-            self.write(f"({end})")
-            self.write("@R14")
-            self.write("D=M")
-        elif op == "/":
-            self.write("@R13")  # store dividend (left) into R13
-            self.write("M=D")
-            self.write("@0")
-            self.write("D=A")
-            self.write("@R14")  # quotient = 0
-            self.write("M=D")
-            loop = f"DIV_LOOP{next(self.label_count)}"
-            end = f"DIV_END{next(self.label_count)}"
-            self.write(f"({loop})")
-            self.write("@R13")  # D = dividend
-            self.write("D=M")
-            self.write(f"@{right}")  # D = dividend - divisor
-            self.write("D=D-M" if not_int else "D=D-A")
-            self.write(f"@{end}")  # if dividend < divisor, end
-            self.write("D;JLT")
-            self.write("@R13")  # dividend = dividend - divisor
-            self.write("M=D")
-            self.write("@R14")  # quotient++
-            self.write("M=M+1")
-            self.write(f"@{loop}")  # repeat
-            self.write("0;JMP")
-            self.write(f"({end})")  # end label
-            self.write("@R14")  # load quotient
+                self.load("R14")
+                self.write("M=D")  # R14 = divisor
+                self.call_runtime("DIV")  # R13 = quotient, R15 = remainder
+                self.divmod_operands = operands
+            self.load("R13" if op == "/" else "R15")
             self.write("D=M")
         else:
             raise NotImplementedError(f"{op} not implemented")
 
-        self.write(f"@{dest_addr}")
+        self.load(dest_addr)
         self.write("M=D")
+        self.forget_divmod(dest_addr)
 
-    def compile_condition(self, left, op, right):
+    def compile_condition(self, left, op, right, when=False):
+        # D = left - right; returns the jump taken when the comparison is `when`.
         if isinstance(left, int):
-            self.write(f"@{left}")
+            self.load(left)
             self.write("D=A")
         else:
             addr = self.get_var_addr(left)
-            self.write(f"@{addr}")
+            self.load(addr)
             self.write("D=M")
 
         if isinstance(right, int):
-            self.write(f"@{right}")
+            self.load(right)
             self.write("D=D-A")
         else:
             addr = self.get_var_addr(right)
-            self.write(f"@{addr}")
+            self.load(addr)
             self.write("D=D-M")
 
-        jump_map = {">": "JLE", "<": "JGE", "==": "JNE", "!=": "JEQ", ">=": "JLT", "<=": "JGT"}
+        if when:
+            jump_map = {">": "JGT", "<": "JLT", "==": "JEQ", "!=": "JNE", ">=": "JGE", "<=": "JLE"}
+        else:
+            jump_map = {">": "JLE", "<": "JGE", "==": "JNE", "!=": "JEQ", ">=": "JLT", "<=": "JGT"}
         return jump_map[op]
 
-    def compile_for(self, init_str, condition_str, increment_str, func):
-        # Parse and emit initialization, Example: i = 0
-        m_init = re.match(r"(\w+)\s*=\s*(.+)", init_str)
-        if m_init:
-            var, expr = m_init.groups()
-            var = var.strip()
-            expr = expr.strip()
-            if expr.isdigit():
-                self.compile_assign(var, int(expr))
+    def compile_operand(self, node):
+        # Reduce an expression to something compile_math/compile_condition
+        # take directly: an int, a variable, or a temporary holding the value
+        # (which the caller frees).
+        if isinstance(node, tuple):
+            return self.compile_expr(node)
+        return self.constant(node)
+
+    def compile_condition_jumps(self, condition, target, when=False):
+        # Jump to target if the condition comes out as `when`, else fall
+        # through. "and" and "or" short-circuit: the right side is only
+        # evaluated when the left one does not decide the outcome.
+        op = condition[0]
+        if op == "not":
+            self.compile_condition_jumps(condition[1], target, not when)
+            return
+        if op in ("and", "or"):
+            decisive = op == "or"  # the value of the left side that decides the whole
+            if when == decisive:
+                self.compile_condition_jumps(condition[1], target, when)
+                self.compile_condition_jumps(condition[2], target, when)
             else:
-                self.compile_assign(var, expr)
-        else:
-            raise SyntaxError(f"Unsupported for-loop init: {init_str}")
-        start_label = f"FOR_START{next(self.label_count)}"
-        end_label = f"FOR_END{next(self.label_count)}"
-        self.write(f"({start_label})")
-
-        # Condition
-        m_cond = re.match(r"(\w+|\d+)\s*(==|!=|>=|<=|>|<)\s*(\w+|\d+)", condition_str)
-        if not m_cond:
-            raise SyntaxError(f"Unsupported for-loop condition: {condition_str}")
-        left, op, right = m_cond.groups()
-        left = int(left) if left.isdigit() else left
-        right = int(right) if right.isdigit() else right
-        jump_instr = self.compile_condition(left, op, right)
-        self.write(f"@{end_label}")
+                skip_label = f"{op.upper()}_SKIP{next(self.label_count)}"
+                self.compile_condition_jumps(condition[1], skip_label, decisive)
+                self.compile_condition_jumps(condition[2], target, when)
+                self.label(skip_label)
+            return
+        left, right = condition[1], condition[2]
+        left = self.compile_operand(fold(left))
+        right = self.compile_operand(fold(right))
+        jump_instr = self.compile_condition(left, op, right, when)
+        self.free_temp(left)
+        self.free_temp(right)
+        self.load(target)
         self.write(f"D;{jump_instr}")
 
-        func() # Body
-        # Increment, Example: i = i + 1
-        other_branch = False
-        if "++" in increment_str:
-            var = increment_str.split("+")[0]
-            var = int(var) if var.isdigit() else var.strip()
-            self.compile_math(var, var, "+", 1)
-            other_branch = True
-        elif "--" in increment_str:
-            var = increment_str.split("-")[0]
-            var = int(var) if var.isdigit() else var.strip()
-            self.compile_math(var, var, "-", 1)
-            other_branch = True
-        m_incr = re.match(r"(\w+)\s*=\s*(\w+)\s*([\+\-\*/])\s*(\w+|\d+)", increment_str)
-        if m_incr:
-            var, left, op, right = m_incr.groups()
-            var = var.strip()
-            left = left.strip()
-            op = op.strip()
-            right = int(right) if right.isdigit() else right.strip()
-            self.compile_math(var, left, op, right)
-        if not m_incr and not other_branch:
-            raise SyntaxError(f"Unsupported for-loop increment: {increment_str}")
-
-        # Jump back to start
-        self.write(f"@{start_label}")
-        self.write("0;JMP")
-        self.write(f"({end_label})")
+    def compile_loop(self, kind, condition, body, setup=None, test=None):
+        # The test sits after the body, so a round costs one conditional
+        # jump; a copy in front skips a loop that does not run at all.
+        # Always-true loops just jump back. setup() emits code that runs once
+        # between the guard and the first round, and test (default: the
+        # condition) is the bottom test, which may read what setup computed.
+        start_label = f"{kind}_START{next(self.label_count)}"
+        end_label = f"{kind}_END{next(self.label_count)}"
+        if condition is not True:
+            self.compile_condition_jumps(condition, end_label)
+        if setup is not None:
+            setup()
+        self.label(start_label)
+        body()
+        if condition is True:
+            self.load(start_label)
+            self.write("0;JMP")
+        else:
+            self.compile_condition_jumps(condition if test is None else test, start_label, True)
+        self.label(end_label)
+
+    def compile_for(self, init, condition, increment, body):
+        # Loops take their bodies as statement lists (not functions like
+        # compile_if) so the loop pass can rewrite them.
+        self.visit(init)
+        self.compile_while(condition, body + [increment], "FOR")
+
+    def compile_while(self, condition, body, kind="WHILE"):
+        condition = fold_condition(condition)
+        if condition is False:
+            return
+        setup, test = [], condition
+        if self.loops:
+            setup, test, body = optimize_loop(condition, body, self.loop_var)
+        self.compile_loop(kind, condition, lambda: self.visit_block(body),
+                          lambda: self.visit_block(setup), test)
 
-    def compile_if(self, condition_str, func):
+    def compile_if(self, condition, func):
+        # Constant conditions are decided here and the dead body is dropped.
+        condition = fold_condition(condition)
+        if condition is True:
+            func()
+        elif condition is not False:
+            end_label = f"IF_END{next(self.label_count)}"
+            self.compile_condition_jumps(condition, end_label)
+            func()
+            self.label(end_label)
+
+    def compile_if_else(self, condition, func, else_func):
+        condition = fold_condition(condition)
+        if condition is True:
+            func()
+            return
+        if condition is False:
+            else_func()
+            return
+        else_label = f"IF_ELSE{next(self.label_count)}"
         end_label = f"IF_END{next(self.label_count)}"
-        or_parts = [part.strip() for part in condition_str.split("or")]
-        for or_part in or_parts:
-            and_parts = [p.strip() for p in or_part.split("and")]
-            for condition in and_parts:
-                m = re.match(r"(\w+|\d+)\s*(==|!=|>=|<=|>|<)\s*(\w+|\d+)", condition)
-                if not m:
-                    raise SyntaxError(f"Unsupported condition: {condition}")
-                left, op, right = m.groups()
-                left = int(left) if left.isdigit() else left
-                right = int(right) if right.isdigit() else right
-                jump_instr = self.compile_condition(left, op, right)
-
-                self.write(f"@{end_label}")
-                self.write(f"D;{jump_instr}")
-        func()
-        self.write(f"({end_label})")
-
-    def compile_while(self, condition_str, func):
-        start_label = f"WHILE_START{next(self.label_count)}"
-        end_label = f"WHILE_END{next(self.label_count)}"
-        self.write(f"({start_label})")
-
-        or_parts = [part.strip() for part in condition_str.split("or")]
-        for or_part in or_parts:
-            and_parts = [p.strip() for p in or_part.split("and")]
-            for condition in and_parts:
-                m = re.match(r"(\w+|\d+)\s*(==|!=|>=|<=|>|<)\s*(\w+|\d+)", condition)
-                if not m:
-                    raise SyntaxError(f"Unsupported condition: {condition}")
-                left, op, right = m.groups()
-                left = int(left) if left.isdigit() else left
-                right = int(right) if right.isdigit() else right
-                jump_instr = self.compile_condition(left, op, right)
-
-                self.write(f"@{end_label}")
-                self.write(f"D;{jump_instr}")
+        self.compile_condition_jumps(condition, else_label)
         func()
-        self.write(f"@{start_label}")
+        self.load(end_label)
         self.write("0;JMP")
-        self.write(f"({end_label})")
+        self.label(else_label)
+        else_func()
+        self.label(end_label)
 
     def compile_print(self, value, mode="PRINT"):
         if isinstance(value, int):
-            self.write(f"@{value}")
+            self.load(value)
             self.write("D=A")
         else:
             if isinstance(value, str) and value.isdigit():
-                self.write(f"@{int(value)}")
+                self.load(int(value))
                 self.write("D=A")
             else:
                 addr = self.get_var_addr(value)
-                self.write(f"@{addr}")
+                self.load(addr)
                 self.write("D=M")
         self.write(f"{mode} D")
 
+    # Code generation from the syntax tree (see nodes.py). Each visit_* method
+    # handles one statement type by calling the compile_* methods above.
+
+    def compile_program(self, statements):
+        self.visit_block(statements)
+
+    def visit(self, node):
+        outer, self.line = self.line, node.line
+        getattr(self, f"visit_{type(node).__name__.lower()}")(node)
+        self.line = outer
+
+    def visit_block(self, statements):
+        for statement in statements:
+            self.visit(statement)
+
+    def visit_assign(self, node):
+        tree = fold(node.expr)
+        if isinstance(tree, tuple):
+            self.compile_expr(tree, node.name)
+        elif tree != node.name:
+            self.compile_assign(node.name, tree)
+
+    def visit_while(self, node):
+        self.compile_while(node.cond, node.body)
+
+    def visit_if(self, node):
+        if node.else_body is None:
+            self.compile_if(node.cond, lambda: self.visit_block(node.body))
+        else:
+            self.compile_if_else(node.cond, lambda: self.visit_block(node.body),
+                                 lambda: self.visit_block(node.else_body))
+
+    def visit_for(self, node):
+        self.compile_for(node.init, node.cond, node.step, node.body)
+
+    def visit_print(self, node):
+        value = self.compile_operand(fold(node.value))
+        self.compile_print(value, mode=node.mode)
+        self.free_temp(value)
+        if node.newline:
+            self.compile_print(10, mode="PRINT_CHAR")
+
+    def visit_printstring(self, node):
+        for char in node.text:
+            # PRINT_CHAR prints the low byte of D, which also keeps
+            # characters past 0x7FFF (say an emoji) within an A-instruction.
+            self.compile_print(ord(char) & 0xFF, mode="PRINT_CHAR")
+        if node.newline:
+            self.compile_print(10, mode="PRINT_CHAR")
+
+    def finish(self):
+        """Append the runtime routines, place the constant pool and run the
+        peephole passes. Returns the finished instructions (also left in
+        self.asm)."""
+        if self.runtime:
+            # Routines go after the program; jump over them to halt.
+            self.load("PROGRAM_END")
+            self.write("0;JMP")
+            for name in self.runtime:
+                getattr(self, f"write_{name.lower()}_routine")()
+            self.label("PROGRAM_END")
+        if self.constants:
+            # The constant pool goes after all other data, in one block.
+            addresses = {}
+            for value, name in self.constants.items():
+                addresses[name] = self.next_ram
+                self.ram_init[self.next_ram] = value
+                self.next_ram += 1
+            self.asm = [("a", addresses[instr[1]]) if instr[0] == "a" and instr[1] in addresses else instr
+                        for instr in self.asm]
+        if self.peephole:
+            self.asm, self.peephole_removed = optimize(self.asm, self.peephole)
+        return self.asm
+
     def compile(self):
-        return assemble("\n".join(self.asm))
+        self.finish()
+        rom, self.labels = encode(self.asm, with_labels=True, isa=self.isa)
+        return rom
+
+    def assembly(self):
+        """The program as assembly text, for reading and debugging."""
+        return "\n".join(format_line(instr) for instr in self.asm) + "\n"
@@ -1,8 +1,16 @@
+import hashlib
+import struct
+import sys
 import time
-from alu import alu
+from array import array
+from alu import alu_fn, alu_ref_fn, ext_ops, signed64, MASK, SIGN
+from blocks import find_leaders, translate_block
+from assembler import split_word, read_image
+from idioms import find_idioms
+from output import OutputSink
 
 
-MASK = (1 << 64) - 1  # updated mask for 64 bits
+RAM_SIZE = 2**16
 
 def int_to_bin(v):
     return format(v & MASK, f"064b")  # 64 bits
@@ -10,12 +18,6 @@ def int_to_bin(v):
 def bin_to_int(s):
     return int(s, 2)
 
-def signed64(v):
-    SIGN = 1 << (64 - 1)
-    if v & SIGN:
-        return v - (1 << 64)
-    return v
-
 def format_bytes(num_bytes):
     for unit in ['bytes', 'KB', 'MB', 'GB', 'TB']:
         if num_bytes < 1024.0:
@@ -23,94 +25,382 @@ def format_bytes(num_bytes):
         num_bytes /= 1024.0
     return f"{num_bytes:.2f}"
 
+# print_bits -> what a C-instruction prints after it has executed
+NO_PRINT, PRINT, PRINT_CHAR = 0, 1, 2
+print_modes = {0b01: PRINT, 0b10: PRINT_CHAR, 0b11: NO_PRINT, 0b00: NO_PRINT}
+
+# What CPU.run_for() / run_until() return
+HALTED = "halted"  # pc ran off the end of the ROM
+EXHAUSTED = "exhausted"  # the step budget or deadline ran out; call again to resume
+ERROR = "error"  # an instruction raised; the exception is in CPU.error
+
+# Snapshot file (CPU.snapshot / CPU.restore): a header with the registers,
+# step count, RAM size and a SHA-256 of the ROM, then the written RAM as runs
+# of consecutive addresses: (start, length) as two uint32, followed by that
+# many uint64 words. Everything is little-endian.
+SNAPSHOT_MAGIC = b"LSNP"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sHH32sQQQQII")  # magic, version, flags, rom hash, A, D, pc, steps, ram size, runs
+SNAPSHOT_RUN = struct.Struct("<II")
+
+def rom_hash(rom):
+    """SHA-256 identifying a ROM, whatever form (bit strings, ints) it is in."""
+    words = array("Q", (int(word, 2) if isinstance(word, str) else word for word in rom))
+    if sys.byteorder == "big":
+        words.byteswap()
+    return hashlib.sha256(words.tobytes()).digest()
+
+# jump_bits -> predicate on the (unsigned, masked) D register
+jump_predicates = {
+    0b000: None,
+    0b001: lambda d: 0 < d < SIGN,          # JGT
+    0b010: lambda d: d == 0,                # JEQ
+    0b011: lambda d: d < SIGN,              # JGE
+    0b100: lambda d: d >= SIGN,             # JLT
+    0b101: lambda d: d != 0,                # JNE
+    0b110: lambda d: d == 0 or d >= SIGN,   # JLE
+    0b111: lambda d: True,                  # JMP
+}
+
+def decode(instr, reference_alu=False, isa="hack"):
+    """Decode one ROM word into the tuple CPU.step() dispatches on.
+
+    A-instructions become ``(False, value)``. C-instructions become
+    ``(True, print_mode, a_bit, comp, write_A, write_D, write_M, jump)`` where
+    ``comp(x, y)`` is the ALU specialised to the six control bits and ``jump``
+    is a predicate on D (None when the instruction never jumps). With
+    isa="extended" the comp codes in alu.ext_ops run those operations.
+    Where a fast-forward handler from idioms.py starts, CPU.__init__ wraps
+    the decoded tuple as ``(None, handler, decoded)``.
+    """
+    fields = split_word(instr)
+    if fields[0] == "a":
+        return (False, fields[1])
+    _, print_bits, a_bit, comp_bits, dest_bits, jump_bits = fields
+    if isa == "extended" and (a_bit, comp_bits) in ext_ops:
+        comp = ext_ops[a_bit, comp_bits]
+    else:
+        make_comp = alu_ref_fn if reference_alu else alu_fn
+        comp = make_comp(*[(comp_bits >> shift) & 1 for shift in range(5, -1, -1)])  # zx,nx,zy,ny,f,no
+    return (True, print_modes[print_bits], a_bit == 1, comp,
+            bool(dest_bits & 0b100), bool(dest_bits & 0b010), bool(dest_bits & 0b001),
+            jump_predicates[jump_bits])
+
 class CPU:
-    def __init__(self, rom):
-        self.A = "0" * 64
-        self.D = "0" * 64
+    def __init__(self, rom, reference_alu=False, engine="interp", output=None, ram_size=RAM_SIZE,
+                 fast_forward=True, isa="hack", ram_init=None):
+        if engine not in ("interp", "blocks"):
+            raise ValueError(f"Unknown engine: {engine}")
+        if isa not in ("hack", "extended"):
+            raise ValueError(f"Unknown instruction set: {isa}")
+        if engine == "blocks" and reference_alu:
+            raise ValueError("The reference ALU is only available with the interp engine")
+        self.A = 0
+        self.D = 0
         self.pc = 0
+        self.steps = 0  # instructions executed so far
+        self.halted = False
+        self.error = None  # exception that stopped run_for() / run_until()
         self.rom = rom
-        self.ram = ["0" * 64 for _ in range(2**16)]
+        # One unsigned 64-bit word per address, plus a bitmap with one bit per
+        # address that has ever been written through M. A smaller ram_size
+        # saves memory when hosting many CPUs; addressing past it is an error.
+        self.ram = array("Q", bytes(8 * ram_size))
+        self.written = bytearray((ram_size + 7) // 8)
+        # ram_init ({address: value}, such as Compiler.ram_init with the
+        # constant pool) is loaded before the program starts, and counts as
+        # written so snapshots keep it.
+        for address, value in (ram_init or {}).items():
+            self.ram[address] = value & MASK
+            self.written[address >> 3] |= 1 << (address & 7)
+        # reference_alu runs the bit-string ALU from alu.py; it is much slower
+        # and only meant for checking the integer ALU against the chip model.
+        self.reference_alu = reference_alu
+        # Where PRINT / PRINT_CHAR output goes; see output.py.
+        self.output = output if output is not None else OutputSink()
+        # isa="extended" adds the native shift, multiply and divide comps
+        # (assembler.ext_comp_table) to the Hack ones.
+        self.isa = isa
+        self.program = [decode(instr, reference_alu, isa) for instr in rom]
+        # fast_forward runs the loops idioms.py recognises (the MUL and DIV
+        # routines, simple counted loops) as one closed-form update with the
+        # same RAM, registers and step count. Turn it off to check that.
+        self.fast_forward = fast_forward
+        self.idioms = find_idioms(rom) if fast_forward else {}
+        for pc, handler in self.idioms.items():
+            self.program[pc] = (None, handler, self.program[pc])
+        self.step_limit = None  # budget of the current run_for(), for the handlers
+        # engine="blocks" runs translated basic blocks (see blocks.py) instead
+        # of calling step() once per instruction. blocks maps a start address
+        # to (function, length) and is filled in as execution reaches them.
+        self.engine = engine
+        self.blocks = {}
+        self.leaders = find_leaders(rom) if engine == "blocks" else None
+
+    @classmethod
+    def from_image(cls, path, **kwargs):
+        """Build a CPU for a ROM image written by assembler.write_image.
+
+        The file is memory-mapped, not read or parsed. The instruction set
+        and initial RAM come from the image unless given."""
+        rom, isa, ram_init = read_image(path, with_info=True)
+        kwargs.setdefault("isa", isa)
+        kwargs.setdefault("ram_init", ram_init)
+        return cls(rom, **kwargs)
 
     def step(self):
         try:
-            instr = self.rom[self.pc]
-            if instr[0] == "0":
-                self.A = instr[1:].zfill(64)  # 64 bits
+            op = self.program[self.pc]
+            if op[0] is None:
+                # An idiom start: run the instruction itself when the
+                # handler declines or fast-forwarding is off.
+                if self.fast_forward and op[1](self):
+                    return
+                op = op[2]
+            self.steps += 1
+            if not op[0]:
+                self.A = op[1]
                 self.pc += 1
                 return
 
-            print_bits = instr[1:3]
-            a_bit = instr[3]
-            comp_bits = instr[4:10]   # six bits: zx,nx,zy,ny,f,no
-            dest_bits = instr[10:13]  # A, D, M
-            jump_bits = instr[13:16]
-
-            x = self.D
-            addrA = bin_to_int(self.A)
-            y = self.ram[addrA] if a_bit == "1" else self.A
-
-            # run ALU (zx,nx,zy,ny,f,no)
-            zx, nx, zy, ny, f, no = [int(b) for b in comp_bits]
-            out, zr, ng = alu(x, y, zx, nx, zy, ny, f, no)
+            _, print_mode, a_bit, comp, write_A, write_D, write_M, jump = op
 
-            write_A = (dest_bits[0] == "1")
-            write_D = (dest_bits[1] == "1")
-            write_M = (dest_bits[2] == "1")
+            addrA = self.A
+            out = comp(self.D, self.ram[addrA] if a_bit else addrA)
 
             if write_M:
                 self.ram[addrA] = out
+                self.written[addrA >> 3] |= 1 << (addrA & 7)
             if write_D:
                 self.D = out
             if write_A:
                 self.A = out
 
             # 64-bit output and jump logic
-            d_value = bin_to_int(self.D)
-            d_signed = signed64(d_value)
-            if print_bits == "01":
-                print(d_signed, end="")
-            elif print_bits == "10":
-                char_code = d_value & 0xFF
-                print(chr(char_code), end="")
-
-            do_jump = False
-            if jump_bits == "001" and d_signed > 0:    # JGT
-                do_jump = True
-            elif jump_bits == "010" and d_signed == 0: # JEQ
-                do_jump = True
-            elif jump_bits == "011" and d_signed >= 0: # JGE
-                do_jump = True
-            elif jump_bits == "100" and d_signed < 0:  # JLT
-                do_jump = True
-            elif jump_bits == "101" and d_signed != 0: # JNE
-                do_jump = True
-            elif jump_bits == "110" and d_signed <= 0: # JLE
-                do_jump = True
-            elif jump_bits == "111" and True:          # JMP
-                do_jump = True
-
-            if do_jump:
-                self.pc = bin_to_int(self.A)
+            if print_mode == PRINT:
+                self.output.write(str(signed64(self.D)))
+            elif print_mode == PRINT_CHAR:
+                self.output.write(chr(self.D & 0xFF))
+
+            if jump and jump(self.D):
+                self.pc = self.A
             else:
                 self.pc += 1
         except Exception as e:
             import sys
+            self.output.flush()
             print(f"Runtime Error at PC={self.pc}: {e}", file=sys.stderr)
-            print(f"Instruction: {self.rom[self.pc]}", file=sys.stderr)
+            instr = self.rom[self.pc]
+            if not isinstance(instr, str):
+                instr = format(instr, "016b")
+            print(f"Instruction: {instr}", file=sys.stderr)
             raise
 
-    def run(self, diagnostics = False):
+    def written_runs(self):
+        """Yield (start, length) for every run of consecutive written
+        addresses."""
+        start = prev = None
+        for address in self.written_addresses():
+            if prev is not None and address == prev + 1:
+                prev = address
+                continue
+            if start is not None:
+                yield start, prev - start + 1
+            start = prev = address
+        if start is not None:
+            yield start, prev - start + 1
+
+    def snapshot(self, path=None):
+        """Serialise A, D, pc, the step count and the written RAM.
+
+        Returns the snapshot bytes and also writes them to path if given.
+        Output already produced is not part of the snapshot."""
+        runs = list(self.written_runs())
+        parts = [SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, rom_hash(self.rom),
+                                      self.A & MASK, self.D & MASK, self.pc, self.steps,
+                                      len(self.ram), len(runs))]
+        for start, length in runs:
+            words = self.ram[start:start + length]
+            if sys.byteorder == "big":
+                words.byteswap()
+            parts.append(SNAPSHOT_RUN.pack(start, length))
+            parts.append(words.tobytes())
+        data = b"".join(parts)
+        if path is not None:
+            with open(path, "wb") as f:
+                f.write(data)
+        return data
+
+    def restore(self, data):
+        """Load a snapshot taken with snapshot() (bytes, or a file path) into
+        this CPU, replacing its registers and RAM. The snapshot must come
+        from the same ROM."""
+        if isinstance(data, str):
+            with open(data, "rb") as f:
+                data = f.read()
+        if len(data) < SNAPSHOT_HEADER.size:
+            raise ValueError("Not a CPU snapshot: too short")
+        magic, version, _flags, digest, A, D, pc, steps, ram_size, nruns = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("Not a CPU snapshot: bad magic")
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {version}")
+        if digest != rom_hash(self.rom):
+            raise ValueError("Snapshot was taken with a different ROM")
+        if ram_size > len(self.ram):
+            raise ValueError(f"Snapshot needs {ram_size} words of RAM, this CPU has {len(self.ram)}")
+
+        ram = array("Q", bytes(8 * len(self.ram)))
+        written = bytearray(len(self.written))
+        offset = SNAPSHOT_HEADER.size
+        for _ in range(nruns):
+            start, length = SNAPSHOT_RUN.unpack_from(data, offset)
+            offset += SNAPSHOT_RUN.size
+            words = array("Q", data[offset:offset + 8 * length])
+            offset += 8 * length
+            if len(words) != length or start + length > len(ram):
+                raise ValueError("Truncated or corrupt CPU snapshot")
+            if sys.byteorder == "big":
+                words.byteswap()
+            ram[start:start + length] = words
+            for address in range(start, start + length):
+                written[address >> 3] |= 1 << (address & 7)
+
+        self.ram, self.written = ram, written
+        self.A, self.D, self.pc, self.steps = A, D, pc, steps
+        self.halted = False
+        self.error = None
+
+    def written_addresses(self):
+        """Yield every RAM address that has been written, in order."""
+        for byte_index, bits in enumerate(self.written):
+            if bits:
+                base = byte_index << 3
+                for bit in range(8):
+                    if bits & (1 << bit):
+                        yield base + bit
+
+    def run_blocks(self, max_steps=None):
+        # With max_steps, stop before a block that would overrun the budget;
+        # the caller steps through the rest one instruction at a time.
+        blocks = self.blocks
+        ram, written = self.ram, self.written
+        emit = self.output.write
+        end = len(self.rom)
+        A, D, pc = self.A, self.D, self.pc
+        steps = self.steps
+        limit = None if max_steps is None else steps + max_steps
+        idioms = self.idioms if self.fast_forward else {}
+        try:
+            while pc < end:
+                entry = blocks.get(pc)
+                if entry is None:
+                    entry = blocks[pc] = translate_block(self.rom, pc, self.leaders, self.isa)
+                if pc in idioms:
+                    self.A, self.D, self.pc, self.steps = A, D, pc, steps
+                    if idioms[pc](self):
+                        A, D, pc, steps = self.A, self.D, self.pc, self.steps
+                        continue
+                if limit is not None and steps + entry[1] > limit:
+                    break
+                A, D, pc = entry[0](A, D, ram, written, emit)
+                steps += entry[1]
+        except Exception as e:
+            import sys
+            self.output.flush()
+            print(f"Runtime Error in block starting at PC={pc}: {e}", file=sys.stderr)
+            raise
+        finally:
+            self.A, self.D, self.pc = A, D, pc
+            self.steps = steps
+
+    def run_profiled(self, profile):
+        # Same as stepping through the program, plus the bookkeeping for a
+        # profiler.Profile. Kept apart from step() and run_blocks() so runs
+        # without a profile pay nothing for it. Idioms are not fast-forwarded,
+        # so the counts show where the time would really go.
+        program = self.program
+        counts, taken, not_taken = profile.counts, profile.taken, profile.not_taken
+        end = len(self.rom)
+        fast_forward, self.fast_forward = self.fast_forward, False
+        try:
+            while self.pc < end:
+                pc = self.pc
+                counts[pc] += 1
+                self.step()
+                op = program[pc]
+                if op[0] is None:
+                    op = op[2]
+                if op[0] and op[7] is not None:
+                    if op[7](self.D):
+                        taken[pc] += 1
+                    else:
+                        not_taken[pc] += 1
+        finally:
+            self.fast_forward = fast_forward
+
+    def halt(self):
+        # End of program: finish the output line once, however we got here.
+        if not self.halted:
+            self.halted = True
+            self.output.write("\n")
+            self.output.flush()
+
+    def run_for(self, max_steps):
+        """Execute at most max_steps instructions.
+
+        Returns HALTED, EXHAUSTED (call again to carry on where it stopped)
+        or ERROR (the exception is kept in self.error).
+        """
+        if self.error is not None:
+            return ERROR
+        end = len(self.rom)
+        limit = self.steps + max_steps
+        self.step_limit = limit
+        try:
+            if self.engine == "blocks":
+                self.run_blocks(max_steps)
+            while self.pc < end and self.steps < limit:
+                self.step()
+        except Exception as e:
+            self.error = e
+            self.output.flush()
+            return ERROR
+        finally:
+            self.step_limit = None
+        if self.pc >= end:
+            self.halt()
+            return HALTED
+        return EXHAUSTED
+
+    def run_until(self, deadline, slice_steps=10000):
+        """Like run_for(), but stop at `deadline` (a time.monotonic() value)
+        instead of after a number of steps. The clock is checked every
+        slice_steps instructions."""
+        while True:
+            status = self.run_for(slice_steps)
+            if status != EXHAUSTED or time.monotonic() >= deadline:
+                return status
+
+    def run(self, diagnostics = False, profile=None):
+        # profile: a profiler.Profile to fill in; profiled runs always step
+        # one instruction at a time, whatever the engine.
         try:
+            if profile is not None:
+                self.run_profiled(profile)
+            elif self.engine == "blocks":
+                self.run_blocks()
             while self.pc < len(self.rom):
                 self.step()
-            print()
+            self.halt()
         except Exception as e:
             import sys
+            self.output.flush()
             print(f"CPU halted due to error: {e}", file=sys.stderr)
 
         # RAM diagnostics
         if diagnostics:
-            used = [(i, v) for i, v in enumerate(self.ram) if v != "0" * 64]
+            used = [i for i in self.written_addresses() if self.ram[i]]
             total = len(self.ram)
             used_count = len(used)
             unused_count = total - used_count
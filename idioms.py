@@ -0,0 +1,537 @@
+# Loop idioms the CPU can fast-forward (CPU(fast_forward=True)).
+#
+# find_idioms(rom) looks at every static jump target for one of two shapes:
+#
+# * The MUL and DIV runtime routines, matched word for word against the code
+#   Compiler emits for them (with and without the peephole passes) except for
+#   the addresses of their slots and labels. A call runs as one Python
+#   computation of everything the routine leaves behind: R13-R15, its slots,
+#   A, D and the return jump.
+#
+# * Counted loops: straight-line code with a test of a counter against a
+#   bound either in front of it, exiting, or behind it, jumping back (see
+#   loop_handler). The body is run on affine forms of the variables; when
+#   every variable it writes comes out as itself plus a term that does not
+#   change between rounds (or as a fresh value) and the counter moves by a
+#   constant step, the trip count and the final values have a closed form.
+#
+# Each idiom becomes a handler(cpu) for the address it starts at. A handler
+# either applies the whole effect, including the step count and the written
+# bitmap, so that nothing can tell it apart from running the instructions,
+# and returns True; or it changes nothing and returns False (the step budget
+# of run_for() is too small, or the operands are out of its range), and the
+# CPU executes the code as usual. A counted loop that does not fit the
+# budget runs the whole rounds that do and stops at the start of the next,
+# so sliced runs (batch mode, the scheduler) still skip long loops; a MUL or
+# DIV call costs a few hundred steps at most and is simply stepped.
+
+from alu import signed64, MASK, SIGN
+from assembler import comp_table, encode_c, parse_line, split_word, symbols
+from peephole import optimize, PASSES
+from runtime import ROUTINES
+
+# (a_bit << 6 | comp_bits) -> comp mnemonic
+comp_names = {int(bits, 2): name for name, bits in comp_table.items()}
+
+def fits(cpu, cost):
+    """Whether `cost` more steps stay within the current run_for() budget."""
+    return cpu.step_limit is None or cpu.steps + cost <= cpu.step_limit
+
+def store(cpu, values):
+    """Write {address: value} to RAM and mark the addresses written."""
+    ram, written = cpu.ram, cpu.written
+    for address, value in values.items():
+        ram[address] = value & MASK
+        written[address >> 3] |= 1 << (address & 7)
+
+# Runtime routines
+
+class Routine:
+    """A runtime routine as the compiler emits it. items holds one entry per
+    instruction: ("c", word), ("const", value), ("slot", name) or
+    ("label", name); labels and jumps are offsets into it."""
+
+    def __init__(self, name, instrs, slot_names):
+        self.name = name
+        self.items = []
+        self.labels = {}
+        self.jumps = []
+        for instr in instrs:
+            if instr[0] == "label":
+                self.labels[instr[1]] = len(self.items)
+            elif instr[0] == "a":
+                self.items.append(("a", instr[1]))
+            else:
+                if instr[4] is not None:
+                    self.jumps.append(len(self.items))
+                self.items.append(("c", encode_c(instr)))
+        for i, (kind, symbol) in enumerate(self.items):
+            if kind != "a":
+                continue
+            if symbol in self.labels:
+                self.items[i] = ("label", symbol)
+            elif symbol in symbols:
+                self.items[i] = ("const", symbols[symbol])
+            elif symbol in slot_names:
+                self.items[i] = ("slot", slot_names[symbol])
+            else:
+                self.items[i] = ("const", symbol)
+
+    def jump(self, label, nth):
+        """Offset of the nth jump at or after `label`."""
+        return [j for j in self.jumps if j >= self.labels[label]][nth - 1]
+
+    def upto(self, label, nth):
+        """Instructions run from `label` through its nth jump."""
+        return self.jump(label, nth) - self.labels[label] + 1
+
+    def fall(self, label, nth, next_label):
+        """Instructions run after falling through the nth jump from `label`
+        until `next_label`."""
+        return self.labels[next_label] - self.jump(label, nth) - 1
+
+    def match(self, rom, base):
+        """{slot name: address} if the routine is at `base`, else None."""
+        if base + len(self.items) > len(rom):
+            return None
+        slots = {}
+        for offset, (kind, value) in enumerate(self.items):
+            word = rom[base + offset]
+            word = int(word, 2) if isinstance(word, str) else word
+            if kind == "c":
+                if word != value:
+                    return None
+            elif word & 0x8000:
+                return None
+            elif kind == "const":
+                if word != value:
+                    return None
+            elif kind == "label":
+                if word != base + self.labels[value]:
+                    return None
+            elif slots.setdefault(value, word) != word:
+                return None
+        return slots
+
+class RoutineWriter:
+    """Collects the instructions a runtime routine writer emits, the way
+    Compiler would, giving every slot an address of its own."""
+
+    def __init__(self):
+        self.asm = []
+        self.slots = {}
+
+    def label(self, name):
+        self.asm.append(("label", name))
+
+    def load(self, value):
+        self.asm.append(("a", value))
+
+    def write(self, line):
+        self.asm.append(parse_line(line))
+
+    def get_var_addr(self, name):
+        return self.slots.setdefault(name, 16 + len(self.slots))
+
+_routines = None
+
+def routines():
+    """Routine templates for every runtime routine, as Compiler.finish()
+    lays them out with all peephole passes and with none."""
+    global _routines
+    if _routines is None:
+        _routines = []
+        for peephole in (True, False):
+            out = RoutineWriter()
+            out.load("PROGRAM_END")
+            out.write("0;JMP")
+            for name in HANDLERS:
+                ROUTINES[name](out)
+            out.label("PROGRAM_END")
+            instrs = optimize(out.asm, PASSES)[0] if peephole else out.asm
+            slot_names = {address: name for name, address in out.slots.items()}
+            starts = [instrs.index(("label", name)) for name in HANDLERS]
+            ends = starts[1:] + [instrs.index(("label", "PROGRAM_END"))]
+            for name, start, end in zip(HANDLERS, starts, ends):
+                _routines.append(Routine(name, instrs[start:end], slot_names))
+    return _routines
+
+def mul_handler(t, slots):
+    # Shift-and-add over the bits of R14 (see Compiler.write_mul_routine):
+    # one round per bit up to the highest set one, plus the add for set bits.
+    entry = t.labels["MUL_LOOP"] - t.labels["MUL"]
+    test = t.upto("MUL_LOOP", 2)
+    add = t.fall("MUL_LOOP", 2, "MUL_SKIP")
+    shift = t.upto("MUL_SKIP", 1)
+    done = t.upto("MUL_LOOP", 1) + t.upto("MUL_END", 1)
+    mask, ret = slots["__mul_mask"], slots["__mul_ret"]
+
+    def handler(cpu):
+        ram = cpu.ram
+        x, y = ram[13], ram[14]
+        rounds = y.bit_length()
+        cost = entry + rounds * (test + shift) + bin(y).count("1") * add + done
+        if not fits(cpu, cost):
+            return False
+        values = {15: x * y, mask: 1 << rounds}
+        if rounds:
+            values.update({13: x << rounds, 14: 0})
+        store(cpu, values)
+        cpu.D = ram[15]
+        cpu.A = cpu.pc = ram[ret]
+        cpu.steps += cost
+        return True
+    return handler
+
+def div_handler(t, slots):
+    # Mirrors Compiler.write_div_routine branch by branch, adding up the
+    # instructions each branch runs through.
+    zero = t.upto("DIV", 1) + t.upto("DIV_ZERO", 1)
+    start = t.upto("DIV", 2) + t.upto("DIV_NPOS", 1) + t.labels["DIV_SKIP"] - t.labels["DIV_DPOS"]
+    x_neg = t.fall("DIV", 2, "DIV_NPOS")
+    y_neg = t.fall("DIV_NPOS", 1, "DIV_DPOS")
+    skip_round = t.upto("DIV_SKIP", 3)
+    skip_zero = t.upto("DIV_SKIP", 1)
+    skip_exit = t.upto("DIV_SKIP", 2)
+    round_start = t.upto("DIV_LOOP", 1) + t.upto("DIV_SHIFT", 1) + t.upto("DIV_NEXT", 1)
+    top_bit = t.fall("DIV_LOOP", 1, "DIV_SHIFT")
+    r_high = t.upto("DIV_RHIGH", 1)
+    r_high_cmp = t.upto("DIV_RHIGH", 2) - r_high
+    r_low = t.upto("DIV_SHIFT", 2) - t.upto("DIV_SHIFT", 1)
+    r_low_cmp = t.fall("DIV_SHIFT", 2, "DIV_CMP")
+    cmp = t.upto("DIV_CMP", 1)
+    cmp_sub = t.fall("DIV_CMP", 1, "DIV_SUB")
+    sub = t.labels["DIV_NEXT"] - t.labels["DIV_SUB"]
+    loop_exit = t.fall("DIV_NEXT", 1, "DIV_SIGN")
+    finish = t.upto("DIV_SIGN", 1) + t.upto("DIV_QPOS", 1) + t.upto("DIV_RPOS", 1)
+    q_sign = t.fall("DIV_SIGN", 1, "DIV_QPOS")
+    r_sign = t.fall("DIV_QPOS", 1, "DIV_RPOS")
+    q_slot, count, ret = slots["__div_q"], slots["__div_count"], slots["__div_ret"]
+    q_neg, r_neg = slots["__div_qneg"], slots["__div_rneg"]
+
+    def handler(cpu):
+        ram = cpu.ram
+        x, y = ram[13], ram[14]
+        if y == 0:
+            cost = zero
+            values = {15: x, 13: 0}
+            D = x
+        else:
+            cost = start
+            values = {q_neg: 0, r_neg: 0, count: 0}
+            if x & SIGN:
+                x = -x & MASK
+                values[q_neg] = values[r_neg] = MASK
+                cost += x_neg
+            if y & SIGN:
+                y = -y & MASK
+                values[14] = y
+                values[q_neg] ^= MASK
+                cost += y_neg
+            rounds = x.bit_length()
+            cost += (64 - rounds) * skip_round + (skip_exit + loop_exit if rounds else skip_zero)
+            r = q = 0
+            for bit in range(rounds - 1, -1, -1):
+                cost += round_start
+                r = (r << 1) & MASK
+                if x >> bit & 1:
+                    r += 1
+                    cost += top_bit
+                q <<= 1
+                # Both halves below or both above 2**63: compare by subtracting
+                if r & SIGN:
+                    cost += r_high
+                    compare = y & SIGN
+                    if compare:
+                        cost += r_high_cmp
+                else:
+                    cost += r_low
+                    compare = not y & SIGN
+                    if compare:
+                        cost += r_low_cmp
+                if compare:
+                    cost += cmp
+                    subtract = r >= y
+                    if subtract:
+                        cost += cmp_sub
+                else:
+                    subtract = r & SIGN
+                if subtract:
+                    r -= y
+                    q += 1
+                    cost += sub
+            cost += finish
+            if values[q_neg]:
+                q = -q
+                cost += q_sign
+            if values[r_neg]:
+                r = -r
+                cost += r_sign
+            values.update({15: r, q_slot: q, 13: q})
+            D = q & MASK
+        if not fits(cpu, cost):
+            return False
+        store(cpu, values)
+        cpu.D = D
+        cpu.A = cpu.pc = ram[ret]
+        cpu.steps += cost
+        return True
+    return handler
+
+HANDLERS = {"MUL": mul_handler, "DIV": div_handler}
+
+# Counted loops
+
+class NotAffine(Exception):
+    pass
+
+def combine(x, y, sign=1):
+    """x + sign*y for affine forms {address or None (constant): coefficient}."""
+    out = dict(x)
+    for key, coef in y.items():
+        out[key] = out.get(key, 0) + sign * coef
+        if out[key] == 0:
+            del out[key]
+    return out
+
+def comp_form(name, A, D, ram):
+    """Affine form of the ALU output for a comp mnemonic."""
+    def operand(symbol):
+        if symbol == "D":
+            if D is None:
+                raise NotAffine()
+            return D
+        if A is None:
+            raise NotAffine()
+        if symbol == "A":
+            return {None: A}
+        return ram.get(A, {A: 1})
+    if name == "0":
+        return {}
+    if name == "1":
+        return {None: 1}
+    if name == "-1":
+        return {None: -1}
+    if name in ("D", "A", "M"):
+        return operand(name)
+    if name in ("-D", "-A", "-M"):
+        return combine({}, operand(name[1]), -1)
+    if name and len(name) == 3 and name[1] in "+-":
+        right = {None: 1} if name[2] == "1" else operand(name[2])
+        return combine(operand(name[0]), right, 1 if name[1] == "+" else -1)
+    raise NotAffine()  # !x, &, | and undefined comps
+
+def body_effect(rom, start, end):
+    """Run rom[start:end] on affine forms of the RAM as it was at `start`.
+    Returns {address: form} for every address written, and the form of D
+    (None if the code never sets D; reading D before setting it is not
+    affine)."""
+    A, D, ram = None, None, {}
+    for pc in range(start, end):
+        fields = split_word(rom[pc])
+        if fields[0] == "a":
+            A = fields[1]
+            continue
+        _, print_bits, a_bit, comp_bits, dest_bits, jump_bits = fields
+        if jump_bits or print_bits in (0b01, 0b10):
+            raise NotAffine()
+        out = comp_form(comp_names.get(a_bit << 6 | comp_bits), A, D, ram)
+        if dest_bits & 0b001:
+            ram[A] = out
+        if dest_bits & 0b010:
+            D = out
+        if dest_bits & 0b100:
+            A = out.get(None, 0) if set(out) <= {None} else None
+    return ram, D
+
+def trip_count(jump, i, bound, k):
+    """Rounds until `i - bound` satisfies the exit jump, starting from i and
+    adding k each round; None if that never happens."""
+    diff = bound - i
+    if jump == 0b011 and k > 0:  # JGE: while i < bound
+        return max(0, -(-diff // k))
+    if jump == 0b001 and k > 0:  # JGT: while i <= bound
+        return max(0, diff // k + 1)
+    if jump == 0b110 and k < 0:  # JLE: while i > bound
+        return max(0, -(-diff // k))
+    if jump == 0b100 and k < 0:  # JLT: while i >= bound
+        return max(0, diff // k + 1)
+    if jump == 0b010 and k and diff % k == 0 and diff // k >= 0:  # JEQ: while i != bound
+        return diff // k
+    return None
+
+# Counter and bound must stay this small for i - bound not to overflow
+LIMIT = 1 << 62
+
+def is_jump(word):
+    fields = split_word(word)
+    return fields[0] == "c" and fields[5] != 0
+
+def loop_handler(rom, start):
+    """Handler for a counted loop starting at `start`, or None.
+
+    The test is either at the top, "@i D=M @N D=D-A @end D;Jcc" (D=D-M for a
+    variable N) jumping out of the loop, with "@start 0;JMP" after the body;
+    or at the bottom, any "@start D;Jcc" ending the body that jumps back
+    while D, some counter plus a constant minus loop invariants, says so
+    (the compiler's layout, see Compiler.compile_loop)."""
+    fields = [split_word(word) for word in rom[start:start + 6]]
+    top = ([f[0] for f in fields] == ["a", "c", "a", "c", "a", "c"]
+           and fields[1] == ("c", 0b11, 1, 0b110000, 0b010, 0)  # D=M
+           and fields[3][1] == 0b11 and fields[3][3:] == (0b010011, 0b010, 0))  # D=D-A / D=D-M
+    if top:
+        counter, end = fields[0][1], fields[4][1]
+        # The test is i - bound
+        bound = {fields[2][1]: 1} if fields[3][2] else {None: fields[2][1]}
+        offset = 0
+        test = fields[5]
+        body, back = start + 6, end - 2
+        if back < body or end > len(rom):
+            return None
+        if split_word(rom[back]) != ("a", start) or split_word(rom[back + 1]) != ("c", 0b11, 0, 0b101010, 0, 0b111):
+            return None
+    else:
+        back = start
+        while back < len(rom) and not is_jump(rom[back]):
+            back += 1
+        if back >= len(rom) or back - 1 < start or split_word(rom[back - 1]) != ("a", start):
+            return None
+        test = split_word(rom[back])
+        body, end = start, back + 1
+        back -= 1
+    if test[1:5] != (0b11, 0, 0b001100, 0) or test[5] == 0b111:  # D;Jcc
+        return None
+    # Exit condition: the top test jumps out, the bottom one jumps back
+    jump = test[5] if top else test[5] ^ 0b111
+    if jump == 0b101:  # exits on i != bound: no closed form
+        return None
+    try:
+        writes, D = body_effect(rom, body, back)
+    except NotAffine:
+        return None
+    if not top:
+        if D is None:
+            return None
+        counters = [key for key, coef in D.items() if coef == 1 and key in writes]
+        if len(counters) != 1:
+            return None
+        counter = counters[0]
+        offset = D.get(None, 0)
+        bound = {key: -coef for key, coef in D.items() if key not in (counter, None)}
+    step = writes.get(counter)
+    if step is None or step.get(counter) != 1 or set(step) - {counter, None}:
+        return None
+    k = step.get(None, 0)
+    if any(key in writes for key in bound if key is not None):
+        return None
+    # Apart from the counter, every variable the body writes is either
+    # accumulated (v + delta) or given a fresh value (delta). An accumulated
+    # delta may use constants, the counter and variables the body does not
+    # write; a fresh value may also use the accumulated variables.
+    sums, sets = {}, {}
+    for address, form in writes.items():
+        if address == counter:
+            continue
+        own = form.get(address, 0)
+        delta = {key: coef for key, coef in form.items() if key != address}
+        if own not in (0, 1):
+            return None
+        (sums if own else sets)[address] = delta
+    for delta in sums.values():
+        if any(key in writes for key in delta if key not in (None, counter)):
+            return None
+    for delta in sets.values():
+        if any(key in sets for key in delta):
+            return None
+    highest = max(list(writes) + [key for key in bound if key is not None])
+    per_round = end - start
+    # Whole rounds can be run ahead when D after a round is known: the
+    # fresh values are only known as they were at the end of the round.
+    partial = D is not None and not any(key in sets for key in D)
+
+    def rounds(ram, i, m):
+        """The values the body writes as they are after m >= 1 rounds
+        starting with counter i, and the counter and sums as they were
+        before the last of them."""
+        last = i + (m - 1) * k
+        before = {None: 1, counter: last}
+        earlier = (m - 1) * i + k * (m - 1) * (m - 2) // 2  # the counter summed over those rounds
+        values = {}
+        for address, delta in sums.items():
+            invariant = sum(coef * (1 if key is None else ram[key])
+                            for key, coef in delta.items() if key != counter)
+            c = delta.get(counter, 0)
+            before[address] = ram[address] + (m - 1) * invariant + c * earlier
+            values[address] = before[address] + invariant + c * last
+        for address, delta in sets.items():
+            values[address] = sum(coef * (before[key] if key in before else ram[key])
+                                  for key, coef in delta.items())
+        values[counter] = i + m * k
+        return values, before
+
+    def handler(cpu):
+        ram = cpu.ram
+        if highest >= len(ram):
+            return False
+        i = signed64(ram[counter])
+        limit = sum(coef * (1 if key is None else signed64(ram[key])) for key, coef in bound.items())
+        first = i + offset  # what the first test compares against the bound
+        if not (-LIMIT < i < LIMIT and -LIMIT < first < LIMIT and -LIMIT < limit < LIMIT):
+            return False
+        if top:
+            n = trip_count(jump, first, limit, k)
+            cost = n * per_round + 6 if n else 0
+        else:
+            # The body runs once before the first test
+            more = trip_count(jump, first, limit, k)
+            n = None if more is None else 1 + more
+            cost = n * per_round if n else 0
+        if not n:
+            return False
+        tested = first + (n if top else n - 1) * k  # at the test that exits
+        if not (-LIMIT < i + n * k < LIMIT and -LIMIT < tested < LIMIT):
+            return False
+        if fits(cpu, cost):
+            values, _ = rounds(ram, i, n)
+            store(cpu, values)
+            cpu.D = (tested - limit) & MASK
+            cpu.A = end if top else start
+            cpu.pc = end
+            cpu.steps += cost
+            return True
+        # The run_for() budget ends inside the loop: run the rounds that
+        # fit and stop at the start of the next one, for the CPU to step.
+        m = min(n, (cpu.step_limit - cpu.steps) // per_round)
+        if not partial or m < 1:
+            return False
+        values, before = rounds(ram, i, m)
+        cpu.D = sum(coef * (before[key] if key in before else ram[key])
+                    for key, coef in D.items()) & MASK
+        store(cpu, values)
+        cpu.A = start
+        cpu.pc = start
+        cpu.steps += m * per_round
+        return True
+    return handler
+
+def find_idioms(rom):
+    """{ROM address: handler} for every idiom in rom."""
+    targets = set()
+    prev = None
+    for word in rom:
+        fields = split_word(word)
+        if fields[0] == "c" and fields[5] and prev is not None and prev[0] == "a":
+            targets.add(prev[1])
+        prev = fields
+    handlers = {}
+    for target in sorted(t for t in targets if t < len(rom)):
+        for routine in routines():
+            slots = routine.match(rom, target)
+            if slots is not None:
+                handlers[target] = HANDLERS[routine.name](routine, slots)
+                break
+        else:
+            handler = loop_handler(rom, target)
+            if handler is not None:
+                handlers[target] = handler
+    return handlers
@@ -0,0 +1,56 @@
+# Tokenizer for LavaScript source.
+#
+# One regex pass over the whole file. Newlines and comments are dropped (the
+# grammar never needs them), everything else becomes a token tuple
+# (kind, value, line, column) with 1-based positions for error messages.
+# Kinds: "number" (value is an int), "char" (value is its character code),
+# "string" (value is the text between the quotes), "name", "escape" (the \n
+# argument of print), "op" and finally "eof".
+
+import re
+
+TOKEN_RE = re.compile(r"""
+     (?P<newline>\n)
+    |(?P<space>[ \t\r\f\v]+)
+    |(?P<comment>//[^\n]*)
+    |(?P<number>\d+)
+    |(?P<name>[A-Za-z_]\w*)
+    |(?P<char>'[^'\n]')
+    |(?P<string>"[^"\n]*")
+    |(?P<escape>\\n)
+    |(?P<op>==|!=|<=|>=|\+\+|--|[-+*/%&|()<>{};,=])
+    |(?P<error>.)
+""", re.VERBOSE)
+
+def tokenize(source):
+    tokens = []
+    line = 1
+    line_start = 0
+    for m in TOKEN_RE.finditer(source):
+        kind = m.lastgroup
+        if kind == "newline":
+            line += 1
+            line_start = m.end()
+            continue
+        if kind in ("space", "comment"):
+            continue
+        column = m.start() - line_start + 1
+        text = m.group()
+        if kind == "error":
+            if text == "'":
+                raise SyntaxError(f"Bad character literal (line {line}, column {column})")
+            if text == '"':
+                raise SyntaxError(f"Unterminated string literal (line {line}, column {column})")
+            raise SyntaxError(f"Unexpected character {text!r} (line {line}, column {column})")
+        if kind == "number":
+            value = int(text)
+        elif kind == "char":
+            value = ord(text[1])
+        elif kind == "string":
+            value = text[1:-1]
+        else:
+            value = text
+        tokens.append((kind, value, line, column))
+    column = len(source) - line_start + 1
+    tokens.append(("eof", None, line, column))
+    return tokens
@@ -0,0 +1,189 @@
+# Loop optimisation on the syntax tree (see nodes.py), run by the compiler
+# on every while and for loop before it emits the loop.
+#
+# Expressions have no side effects and cannot fail (dividing by zero gives
+# 0), so anything that only reads variables the loop never assigns can be
+# computed once, up front. optimize_loop() rewrites a loop into
+# (setup, test, body), where setup runs once after the guard that skips a
+# loop which does not run at all:
+# - a top-level assignment x = e with e invariant moves to setup when the
+#   loop assigns x nowhere else and does not read it before that point;
+# - other invariant subexpressions, such as k * w, are computed into fresh
+#   variables in setup when every round evaluates them (not when they sit
+#   in an if or an inner loop, which may not run);
+# - a product i * m of an invariant m and an induction variable i (assigned
+#   once per round, at the top level, as i = i + c or i = i - c) becomes a
+#   fresh variable that setup sets to i * m and that moves by c * m right
+#   after i does. Arithmetic wraps modulo 2**64, so the running sum is exact.
+
+from collections import Counter
+
+from nodes import Assign, For, If, Print, While
+from optimizer import CONDITION_OPS, fold
+
+def names(node):
+    """The variables an expression or condition reads."""
+    if isinstance(node, tuple):
+        return names(node[1]) | names(node[2])
+    if isinstance(node, str):
+        return {node}
+    return set()
+
+def effects(node):
+    """(assigned, read) for a statement: a Counter of the variables it
+    assigns and the set it reads, nested blocks included. Loops and ifs keep
+    theirs in node.effects, so nested loops are walked once, not once per
+    enclosing loop. The results are shared and must not be changed."""
+    if isinstance(node, Assign):
+        return Counter([node.name]), names(node.expr)
+    if isinstance(node, Print):
+        return Counter(), names(node.value)
+    if isinstance(node, For):
+        parts = [node.init, node.step] + node.body
+    elif isinstance(node, While):
+        parts = node.body
+    elif isinstance(node, If):
+        parts = node.body + (node.else_body or [])
+    else:
+        return Counter(), set()
+    if node.effects is None:
+        assigned, read = Counter(), names(node.cond)
+        for part in parts:
+            part_assigned, part_read = effects(part)
+            assigned.update(part_assigned)
+            read |= part_read
+        node.effects = assigned, read
+    return node.effects
+
+def assignments(statements):
+    """How often statements assign each variable, nested blocks included."""
+    counts = Counter()
+    for node in statements:
+        counts.update(effects(node)[0])
+    return counts
+
+def reads(statements):
+    """Every variable statements read, nested blocks included."""
+    found = set()
+    for node in statements:
+        found |= effects(node)[1]
+    return found
+
+def rewrite(statements, expr, blocks=True):
+    """Copy of statements with expr() applied to every expression and
+    condition in them. The nodes themselves are never changed. With
+    blocks=False only the ones evaluated every time statements run are
+    rewritten, and nested bodies are left as they are."""
+    inner = (lambda body: rewrite(body, expr)) if blocks else (lambda body: body)
+    out = []
+    for node in statements:
+        if isinstance(node, Assign):
+            node = Assign(node.name, expr(node.expr), node.line)
+        elif isinstance(node, Print):
+            node = Print(expr(node.value), node.mode, node.newline, node.line)
+        elif isinstance(node, For):
+            init = rewrite([node.init], expr)[0]
+            step = inner([node.step])[0]
+            node = For(init, expr(node.cond), step, inner(node.body), node.line)
+        elif isinstance(node, While):
+            node = While(expr(node.cond), inner(node.body), node.line)
+        elif isinstance(node, If):
+            else_body = None if node.else_body is None else inner(node.else_body)
+            node = If(expr(node.cond), inner(node.body), else_body, node.line)
+        out.append(node)
+    return out
+
+def optimize_loop(condition, body, new_name):
+    """Return (setup, test, body) for a loop that runs body while condition
+    holds. condition is a folded condition or True; test is the one to use
+    after setup has run. new_name() names a fresh variable."""
+    # Nested bodies are folded by the compiler when it gets to them, and
+    # here only where products are reduced, below.
+    body = rewrite(body, fold, blocks=False)
+    setup = []
+
+    # Invariant assignments, one at a time: each one moved makes its
+    # variable invariant, which may free the next.
+    counts = assignments(body)
+    moved = True
+    while moved:
+        moved = False
+        for index, node in enumerate(body):
+            if (isinstance(node, Assign) and counts[node.name] == 1
+                    and not names(node.expr) & counts.keys()
+                    and node.name not in reads(body[:index])):
+                setup.append(body.pop(index))
+                del counts[node.name]
+                moved = True
+                break
+
+    def invariant(node):
+        return not names(node) & counts.keys()
+
+    # Invariant subexpressions evaluated every round
+    hoisted = {}
+
+    def hoist(node):
+        if not isinstance(node, tuple):
+            return node
+        op, left, right = node
+        if op not in CONDITION_OPS and invariant(node):
+            if node not in hoisted:
+                hoisted[node] = new_name()
+                setup.append(Assign(hoisted[node], node))
+            return hoisted[node]
+        return (op, hoist(left), hoist(right))
+
+    body = rewrite(body, hoist, blocks=False)
+    test = condition if condition is True else hoist(condition)
+
+    # Induction variables: name -> (index of the update, "+" or "-", step)
+    induction = {}
+    for index, node in enumerate(body):
+        if isinstance(node, Assign) and counts[node.name] == 1 and isinstance(node.expr, tuple):
+            op, left, right = node.expr
+            if op == "+" and right == node.name:
+                left, right = right, left
+            if op in ("+", "-") and left == node.name and invariant(right):
+                induction[node.name] = (index, op, right)
+
+    # Products of an induction variable, as (variable, op, factor)
+    reduced = {}
+
+    def product(node):
+        op, left, right = node
+        if op == "*" and right in induction and invariant(left):
+            left, right = right, left
+        if left in induction and (op == "*" and invariant(right)
+                                  or op == "<<" and right > 1):
+            return (left, op, right)
+        return None
+
+    def reduce(node):
+        if not isinstance(node, tuple):
+            return node
+        key = product(node)
+        if key is None:
+            return (node[0], reduce(node[1]), reduce(node[2]))
+        if key not in reduced:
+            reduced[key] = new_name()
+        return reduced[key]
+
+    if induction:
+        body = rewrite(body, lambda node: reduce(fold(node)))
+        test = test if test is True else reduce(test)
+
+    updates = {}  # index of an induction update -> statements to run after it
+    for key, name in reduced.items():
+        var, op, factor = key
+        index, step_op, step = induction[var]
+        setup.append(Assign(name, (op, var, factor)))
+        delta = fold((op, step, factor))
+        if isinstance(delta, tuple):
+            delta_name = new_name()
+            setup.append(Assign(delta_name, delta))
+            delta = delta_name
+        updates.setdefault(index, []).append(Assign(name, (step_op, name, delta), body[index].line))
+    body = [statement for index, node in enumerate(body)
+            for statement in [node] + updates.get(index, [])]
+    return setup, test, body
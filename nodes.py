@@ -0,0 +1,65 @@
+# Statement nodes of the syntax tree built by parser.Parser.
+#
+# Expressions stay in the tuple form optimizer.fold() works on: an int is a
+# literal, a str is a variable and (op, left, right) an operation. Conditions
+# use the same shape with a comparison ("==", "!=", "<", ">", "<=", ">=") or
+# "and" / "or" as op, and ("not", condition, None) negates one.
+
+class Node:
+    # effects caches, for loops and ifs, what loops.effects() found in them
+    __slots__ = ("line", "effects")
+
+class Assign(Node):
+    __slots__ = ("name", "expr")
+
+    def __init__(self, name, expr, line=None):
+        self.name = name
+        self.expr = expr
+        self.line = line
+
+class While(Node):
+    __slots__ = ("cond", "body")
+
+    def __init__(self, cond, body, line=None):
+        self.cond = cond
+        self.body = body
+        self.line = line
+        self.effects = None
+
+class If(Node):
+    __slots__ = ("cond", "body", "else_body")
+
+    def __init__(self, cond, body, else_body=None, line=None):
+        self.cond = cond
+        self.body = body
+        self.else_body = else_body  # None when there is no else
+        self.line = line
+        self.effects = None
+
+class For(Node):
+    __slots__ = ("init", "cond", "step", "body")
+
+    def __init__(self, init, cond, step, body, line=None):
+        self.init = init  # Assign
+        self.cond = cond
+        self.step = step  # Assign
+        self.body = body
+        self.line = line
+        self.effects = None
+
+class Print(Node):
+    __slots__ = ("value", "mode", "newline")
+
+    def __init__(self, value, mode="PRINT", newline=False, line=None):
+        self.value = value  # expression
+        self.mode = mode  # "PRINT" or "PRINT_CHAR"
+        self.newline = newline
+        self.line = line
+
+class PrintString(Node):
+    __slots__ = ("text", "newline")
+
+    def __init__(self, text, newline=False, line=None):
+        self.text = text
+        self.newline = newline
+        self.line = line
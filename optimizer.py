@@ -0,0 +1,141 @@
+# Compile-time simplification of arithmetic expressions.
+#
+# Expressions are the trees parser.Parser builds by recursive descent (see
+# nodes.py): an int is a literal, a str is a variable name, and a tuple
+# (op, left, right) is a binary operation; unary minus arrives as
+# ("-", 0, x). fold() evaluates constant subtrees with the CPU's 64-bit
+# wraparound, drops identities such as x*1 and x+0, and turns multiplication
+# by a power of two into a chain of doublings, written as ("<<", x, k).
+# Conditions (see nodes.py) have the same shape; fold() simplifies the
+# expressions inside them but leaves the comparisons themselves alone, and
+# fold_condition() decides the parts that are known at compile time.
+
+from alu import ext_div, ext_mod, signed64, MASK
+from assembler import MAX_ADDRESS
+
+CONDITION_OPS = ("==", "!=", "<", ">", "<=", ">=", "and", "or", "not")
+
+# comparison -> test on left - right, as the compiled jump makes it
+COMPARISONS = {
+    "==": lambda d: d == 0,
+    "!=": lambda d: d != 0,
+    "<": lambda d: d < 0,
+    ">": lambda d: d > 0,
+    "<=": lambda d: d <= 0,
+    ">=": lambda d: d >= 0,
+}
+
+def is_literal(value):
+    # Whether an A-instruction can load value; the compiler keeps larger
+    # (and negative) constants in RAM.
+    return isinstance(value, int) and 0 <= value <= MAX_ADDRESS
+
+def evaluate(op, a, b):
+    """Value of `a op b` as the CPU would compute it, as a signed int."""
+    if op == "+":
+        v = a + b
+    elif op == "-":
+        v = a - b
+    elif op == "*":
+        v = a * b
+    elif op == "/":
+        v = ext_div(a & MASK, b & MASK)  # like the DIV routine
+    elif op == "%":
+        v = ext_mod(a & MASK, b & MASK)
+    elif op == "&":
+        v = a & b
+    elif op == "|":
+        v = a | b
+    elif op == "<<":
+        v = a << b
+    else:
+        raise NotImplementedError(f"{op} not implemented")
+    return signed64(v & MASK)
+
+def power_of_two(value):
+    """k if value == 2**k for some k >= 1, else None."""
+    if isinstance(value, int) and value > 1 and value & (value - 1) == 0:
+        return value.bit_length() - 1
+    return None
+
+def fold(node):
+    """Return a simplified expression tree equivalent to `node`."""
+    if not isinstance(node, tuple):
+        return node
+    op, left, right = node
+    left = fold(left)
+    right = fold(right)
+    if op in CONDITION_OPS:
+        return (op, left, right)
+
+    if isinstance(left, int) and isinstance(right, int):
+        # Constants the A-instruction cannot hold go to the compiler's
+        # constant pool.
+        return evaluate(op, left, right)
+
+    if op == "+":
+        if left == 0:
+            return right
+        if right == 0:
+            return left
+    elif op == "-":
+        if right == 0:
+            return left
+        if left == right:
+            return 0
+    elif op == "*":
+        if left == 0 or right == 0:
+            return 0
+        if left == 1:
+            return right
+        if right == 1:
+            return left
+        if power_of_two(right) is not None:
+            return ("<<", left, power_of_two(right))
+        if power_of_two(left) is not None:
+            return ("<<", right, power_of_two(left))
+    elif op == "/":
+        if right == 1:
+            return left
+    elif op == "%":
+        if right == 1:
+            return 0
+    elif op == "&":
+        if left == 0 or right == 0:
+            return 0
+    elif op == "|":
+        if left == 0:
+            return right
+        if right == 0:
+            return left
+    return (op, left, right)
+
+def fold_condition(condition):
+    """Fold a condition. Returns True or False if its value is known at
+    compile time, otherwise the condition with its expressions folded and
+    its constant parts dropped."""
+    op, left, right = condition
+    if op == "not":
+        inner = fold_condition(left)
+        return (not inner) if isinstance(inner, bool) else (op, inner, None)
+    if op in ("and", "or"):
+        left = fold_condition(left)
+        right = fold_condition(right)
+        decisive = op == "or"  # the value of either side that decides the whole
+        if left is decisive or right is decisive:
+            return decisive
+        if left is (not decisive):
+            return right
+        if right is (not decisive):
+            return left
+        return (op, left, right)
+    left = fold(left)
+    right = fold(right)
+    if left == right:
+        difference = 0
+    elif isinstance(left, int) and isinstance(right, int):
+        # The CPU compares by subtracting, with 64-bit wraparound.
+        difference = signed64((left - right) & MASK)
+    else:
+        return (op, left, right)
+    return COMPARISONS[op](difference)
@@ -0,0 +1,56 @@
+import io
+import sys
+
+# When an OutputSink hands its buffer to the underlying stream.
+FLUSH_ON_NEWLINE = "newline"  # after any write containing "\n", or when the buffer is full
+FLUSH_ON_SIZE = "size"        # only when the buffer reaches buffer_size characters
+FLUSH_AT_HALT = "halt"        # only when the CPU halts (or flush() is called)
+FLUSH_POLICIES = (FLUSH_ON_NEWLINE, FLUSH_ON_SIZE, FLUSH_AT_HALT)
+
+class OutputSink:
+    """Buffered writer for the CPU's PRINT / PRINT_CHAR output.
+
+    The CPU calls write() with the text of each print (a decimal number or a
+    single character) and flush() when it halts. stream defaults to whatever
+    sys.stdout is at flush time.
+    """
+
+    def __init__(self, stream=None, flush=FLUSH_ON_NEWLINE, buffer_size=8192):
+        if flush not in FLUSH_POLICIES:
+            raise ValueError(f"Unknown flush policy: {flush}")
+        self.stream = stream
+        self.flush_policy = flush
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.size = 0
+
+    def write(self, text):
+        self.buffer.append(text)
+        if self.flush_policy == FLUSH_AT_HALT:
+            return
+        self.size += len(text)
+        if self.size >= self.buffer_size or (self.flush_policy == FLUSH_ON_NEWLINE and "\n" in text):
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        stream = self.stream if self.stream is not None else sys.stdout
+        stream.write("".join(self.buffer))
+        stream.flush()
+        self.buffer = []
+        self.size = 0
+
+class CaptureSink(OutputSink):
+    """Keep all program output in memory instead of writing it anywhere.
+
+    PRINT_CHAR emits ``chr(D & 0xFF)``, so every character fits in one byte;
+    getvalue() returns the output encoded as latin-1, i.e. exactly those bytes.
+    """
+
+    def __init__(self):
+        super().__init__(io.StringIO(), flush=FLUSH_AT_HALT)
+
+    def getvalue(self):
+        self.flush()
+        return self.stream.getvalue().encode("latin-1")
@@ -1,225 +1,279 @@
-import re
 import sys
 import traceback
 import random
 from compiler import Compiler
+from lexer import tokenize
+from nodes import Assign, While, If, For, Print, PrintString
+from optimizer import CONDITION_OPS
 
-def parse(source_code, debug=True):
-    compiler = Compiler()
-    lines = [line.split("//")[0].strip() for line in source_code.split("\n")]
-    lines = [line for line in lines if line]
+# Binary operators by precedence level, loosest first. Everything from the
+# comparisons down is an arithmetic expression; "and"/"or" and the
+# comparisons produce conditions. A "not" in front of a comparison (or a
+# parenthesised condition) negates it.
+BINARY_LEVELS = [
+    ("or",),
+    ("and",),
+    ("==", "!=", "<", ">", "<=", ">="),
+    ("|",),
+    ("&",),
+    ("+", "-"),
+    ("*", "/", "%"),
+]
+
+# Condition constants; Maybe is decided once, when the program is compiled.
+CONSTANTS = {
+    "True": lambda: ("==", 0, 0),
+    "False": lambda: ("!=", 0, 0),
+    "Maybe": lambda: ("!=", 0, random.randint(0, 1)),
+}
+
+def parse(source_code, debug=True, compiler=None):
+    # Pass a compiler to choose its options or to read its labels and
+    # statistics after compiling.
     try:
-        parse_lines(lines, compiler)
+        return compile_source(source_code, compiler)
     except Exception as e:
         if debug:
             traceback.print_exc()
         error_type = type(e).__name__
         print(f"{error_type}: {e}", file=sys.stderr)
         sys.exit(1)
+
+def compile_source(source_code, compiler=None):
+    """Compile source text to a ROM. Unlike parse(), errors are raised to the
+    caller instead of ending the process. Constants too wide for an
+    A-instruction live in RAM: pass a compiler and give its ram_init to the
+    CPU."""
+    if compiler is None:
+        compiler = Compiler()
+    old_limit = sys.getrecursionlimit()
+    try:
+        tokens = tokenize(source_code)
+        # Parsing and code generation recurse once per nesting level.
+        sys.setrecursionlimit(max(old_limit, 1000 + 16 * nesting_depth(tokens)))
+        program = Parser(tokens).parse_program()
+        compiler.compile_program(program)
+    finally:
+        sys.setrecursionlimit(old_limit)
     return compiler.compile()
 
-def parse_lines(lines, compiler):
-    i = 0
-    while i < len(lines):
-        line = lines[i].strip()
-
-        # Assignment
-        if re.match(r"^\w+\s*=\s*.+$", line):
-            var, expr = [part.strip() for part in line.split("=")]
-            if expr.startswith("'") and expr.endswith("'"):
-                expr = str(ord(expr[1:-1]))
-            parse_assignment(var, expr, compiler)
-
-        # While loop
-        elif line.startswith("while"):
-            m = re.match(r"while\s*\(?(.+?)\)?\s*(\{)?$", line)
-            if not m:
-                raise SyntaxError(f"Unsupported while syntax: {line}")
-
-            condition_str = m.group(1).strip()
-            if not m.group(2):  # No '{' on same line
-                j = i + 1
-                while j < len(lines) and not lines[j].strip():
-                    j += 1
-                if j >= len(lines) or lines[j].strip() != "{":
-                    raise SyntaxError(f"Expected '{{' after while condition on line {i + 1}")
-                i = j
-
-            # Normalize special cases
-            if condition_str == "True":
-                condition_str = "0 == 0"
-            elif condition_str == "False":
-                condition_str = "0 != 0"
-            elif condition_str == "Maybe":
-                condition_str = f"0 != {random.randint(0, 1)}"
-            body_lines, new_i = extract_block(lines, i, block_start="{", block_end="}")
-            i = new_i
-            def body():
-                parse_lines(body_lines, compiler)
-            compiler.compile_while(condition_str, body)
-
-        # If conditional (with optional else)
-        elif line.startswith("if"):
-            m = re.match(r"if\s*\(?(.+?)\)?\s*(\{)?$", line)
-            if not m:
-                raise SyntaxError(f"Unsupported if syntax: {line}")
-            condition_str = m.group(1).strip()
-            if condition_str.startswith("(") and condition_str.endswith(")"):
-                condition_str = condition_str[1:-1].strip()
-
-            if not m.group(2):  # No '{' on same line
-                j = i + 1
-                while j < len(lines) and not lines[j].strip():
-                    j += 1
-                if j >= len(lines) or lines[j].strip() != "{":
-                    raise SyntaxError(f"Expected '{{' after if condition on line {i + 1}")
-                i = j
-            if condition_str == "True":
-                condition_str = "0 == 0"
-            elif condition_str == "False":
-                condition_str = "0 != 0"
-            elif condition_str == "Maybe":
-                condition_str = f"0 != {random.randint(0, 1)}"
-
-            body_lines, new_i = extract_block(lines, i, block_start="{", block_end="}")
-            i = new_i
-
-            # Check for optional else block
-            has_else = False
-            else_body_lines = []
-            if i < len(lines):
-                next_line = lines[i].strip()
-                if next_line.startswith("else"):
-                    has_else = True
-                    m_else = re.match(r"else\s*(\{)?$", next_line)
-                    if not m_else:
-                        raise SyntaxError(f"Unsupported else syntax: {next_line}")
-                    if not m_else.group(1):  # No '{' after else
-                        j = i + 1
-                        while j < len(lines) and not lines[j].strip():
-                            j += 1
-                        if j >= len(lines) or lines[j].strip() != "{":
-                            raise SyntaxError(f"Expected '{{' after else on line {i + 1}")
-                        i = j
-                    else:
-                        i = i  # '{' already present on same line
-                    else_body_lines, new_i = extract_block(lines, i, block_start="{", block_end="}")
-                    i = new_i
-            def body():
-                parse_lines(body_lines, compiler)
-            if has_else:
-                def else_body():
-                    parse_lines(else_body_lines, compiler)
-                compiler.compile_if_else(condition_str, body, else_body)
-            else:
-                compiler.compile_if(condition_str, body)
-
-        # For loop
-        elif line.startswith("for"):
-            m = re.match(r"for\s*\(([^;]+);([^;]+);([^)]+)\)\s*(\{)?$", line)
-            if not m:
-                raise SyntaxError(f"Unsupported for-loop syntax: {line}")
-            init_str = m.group(1).strip()
-            condition_str = m.group(2).strip()
-            increment_str = m.group(3).strip()
-
-            if not m.group(4):  # No '{' on same line
-                j = i + 1
-                while j < len(lines) and not lines[j].strip():
-                    j += 1
-                if j >= len(lines) or lines[j].strip() != "{":
-                    raise SyntaxError(f"Expected '{{' after for loop header on line {i + 1}")
-                i = j
-
-            body_lines, new_i = extract_block(lines, i, block_start="{", block_end="}")
-            i = new_i
-            def body():
-                parse_lines(body_lines, compiler)
-            compiler.compile_for(init_str, condition_str, increment_str, body)
-
-        elif line.startswith("print"):
-            _, var = line.split("(",maxsplit = 1)
-            var = var[:-1].strip()
-            args = var.split(",")
-            var = args[0].strip()
-            special = args[1].strip() if len(args) > 1 else None
-            if line.startswith("printc"):
-                if var.startswith("'") and var.endswith("'"):
-                    var= str(ord(var[1:-1]))
-                compiler.compile_print(var, mode="PRINT_CHAR")
-            elif line.startswith("println"):
-                if var.startswith('"') and var.endswith('"'):
-                    for chr in var[1:-1]:
-                        compiler.compile_print(ord(chr), mode="PRINT_CHAR")
-            else:
-                compiler.compile_print(var, mode="PRINT")
-            if special == "\\n":
-                compiler.compile_print(10, mode="PRINT_CHAR")
-        i += 1
-
-def parse_assignment(var, expr, compiler):
-    expr = expr.strip()
-        # Tokenize the expression
-    tokens = re.findall(r"\d+|\w+|[\+\-\*/\(\)]", expr)
-    # Shunting Yard algorithm for precedence
-    precedence = {'+': 1, '-': 1, '%': 1, '*': 2, '/': 2, '**':3}
-    output = []
-    ops = []
-    for token in tokens:
-        if re.match(r"^\d+$", token) or re.match(r"^\w+$", token):
-            output.append(token)
-        elif token in precedence:
-            while (ops and ops[-1] in precedence and
-                   precedence[ops[-1]] >= precedence[token]):
-                output.append(ops.pop())
-            ops.append(token)
-        elif token == '(': 
-            ops.append(token)
-        elif token == ')':
-            while ops and ops[-1] != '(': 
-                output.append(ops.pop())
-            ops.pop()  # Remove '('
-    while ops:
-        output.append(ops.pop())
-
-    # Evaluate RPN and generate code
-    stack = []
-    temp_id = [0]
-    def get_temp():
-        temp_id[0] += 1
-        return f"__tmp{temp_id[0]}"
-    for token in output:
-        if token in precedence:
-            right = stack.pop()
-            left = stack.pop()
-            tmp = get_temp() if len(stack) > 0 or token != output[-1] else var
-            lval = int(left) if left.isdigit() else left
-            rval = int(right) if right.isdigit() else right
-            compiler.compile_math(tmp, lval, token, rval)
-            stack.append(tmp)
-        else:
-            stack.append(token)
-    # Final assignment if needed
-    if stack and stack[-1] != var:
-        final = stack.pop()
-        if final.isdigit():
-            compiler.compile_assign(var, int(final))
-        else:
-            compiler.compile_assign(var, final)
-
-def extract_block(lines, start_index, block_start="{", block_end="}"):
-    body_lines = []
-    depth = 1
-    i = start_index + 1
-    while i < len(lines) and depth > 0:
-        line = lines[i]
-        if line.strip() == block_start:
+def nesting_depth(tokens):
+    depth = deepest = 0
+    for kind, value, _, _ in tokens:
+        if kind == "op" and value in "({":
             depth += 1
-        elif line.strip() == block_end:
+            deepest = max(deepest, depth)
+        elif kind == "op" and value in ")}":
             depth -= 1
-            if depth == 0:
-                break
+    return deepest
+
+def is_condition(node):
+    return isinstance(node, tuple) and node[0] in CONDITION_OPS
+
+class Parser:
+    """Recursive-descent parser from lexer tokens to a list of statements
+    (see nodes.py)."""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self, offset=0):
+        return self.tokens[min(self.pos + offset, len(self.tokens) - 1)]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        if token[0] != "eof":
+            self.pos += 1
+        return token
+
+    def error(self, message, token=None):
+        _, _, line, column = token or self.peek()
+        return SyntaxError(f"{message} (line {line}, column {column})")
+
+    def describe(self, token):
+        kind, value = token[0], token[1]
+        if kind == "eof":
+            return "end of file"
+        if kind == "string":
+            return f'"{value}"'
+        if kind == "char":
+            return repr(chr(value))
+        return repr(str(value))
+
+    def at(self, value, kind="op"):
+        token = self.peek()
+        return token[0] == kind and token[1] == value
+
+    def accept(self, value, kind="op"):
+        if self.at(value, kind):
+            return self.next()
+        return None
+
+    def expect(self, value, kind="op"):
+        if not self.at(value, kind):
+            raise self.error(f"Expected {value!r}, found {self.describe(self.peek())}")
+        return self.next()
+
+    def expect_name(self):
+        token = self.peek()
+        if token[0] != "name":
+            raise self.error(f"Expected a variable name, found {self.describe(token)}")
+        return self.next()[1]
+
+    # Statements
+
+    def parse_program(self):
+        statements = []
+        while self.peek()[0] != "eof":
+            statements.append(self.parse_statement())
+        return statements
+
+    def parse_block(self):
+        self.expect("{")
+        statements = []
+        while not self.accept("}"):
+            if self.peek()[0] == "eof":
+                raise self.error("Expected '}' before end of file")
+            statements.append(self.parse_statement())
+        return statements
+
+    def parse_statement(self):
+        token = self.peek()
+        kind, value = token[0], token[1]
+        if kind == "name" and self.peek(1)[:2] == ("op", "="):
+            statement = self.parse_assign()
+        elif kind == "name" and value == "while":
+            self.next()
+            statement = While(self.parse_condition(), self.parse_block(), token[2])
+        elif kind == "name" and value == "if":
+            statement = self.parse_if()
+        elif kind == "name" and value == "for":
+            statement = self.parse_for()
+        elif kind == "name" and value in ("print", "printc", "println"):
+            statement = self.parse_print()
+        else:
+            raise self.error(f"Unexpected {self.describe(token)}")
+        self.accept(";")
+        return statement
+
+    def parse_assign(self):
+        token = self.next()
+        self.expect("=")
+        return Assign(token[1], self.parse_value(), token[2])
+
+    def parse_if(self):
+        line = self.next()[2]
+        condition = self.parse_condition()
+        body = self.parse_block()
+        else_body = None
+        if self.accept("else", "name"):
+            if self.at("if", "name"):
+                else_body = [self.parse_if()]
+            else:
+                else_body = self.parse_block()
+        return If(condition, body, else_body, line)
+
+    def parse_for(self):
+        line = self.next()[2]
+        self.expect("(")
+        init = self.parse_assign()
+        self.expect(";")
+        condition = self.parse_condition()
+        self.expect(";")
+        token = self.peek()
+        name = self.expect_name()
+        if self.accept("++"):
+            step = Assign(name, ("+", name, 1), token[2])
+        elif self.accept("--"):
+            step = Assign(name, ("-", name, 1), token[2])
+        else:
+            self.expect("=")
+            step = Assign(name, self.parse_value(), token[2])
+        self.expect(")")
+        return For(init, condition, step, self.parse_block(), line)
+
+    def parse_print(self):
+        token = self.next()
+        self.expect("(")
+        if token[1] == "println":
+            text = self.peek()
+            if text[0] != "string":
+                raise self.error(f"Expected a string, found {self.describe(text)}")
+            self.next()
         else:
-            body_lines.append(line)
-        i += 1
-    return body_lines, i
\ No newline at end of file
+            value = self.parse_value()
+        newline = False
+        if self.accept(","):
+            if self.peek()[0] != "escape":
+                raise self.error(f"Expected \\n, found {self.describe(self.peek())}")
+            self.next()
+            newline = True
+        self.expect(")")
+        if token[1] == "println":
+            return PrintString(text[1], newline, token[2])
+        mode = "PRINT_CHAR" if token[1] == "printc" else "PRINT"
+        return Print(value, mode, newline, token[2])
+
+    # Expressions
+
+    def parse_condition(self):
+        token = self.peek()
+        node = self.parse_binary(0)
+        if not is_condition(node):
+            raise self.error("Expected a condition", token)
+        return node
+
+    def parse_value(self):
+        token = self.peek()
+        node = self.parse_binary(0)
+        if is_condition(node):
+            raise self.error("Expected a value, found a condition", token)
+        return node
+
+    def parse_binary(self, level):
+        if level == len(BINARY_LEVELS):
+            return self.parse_unary()
+        ops = BINARY_LEVELS[level]
+        if "==" in ops and self.at("not", "name"):
+            # "not" binds looser than a comparison: not x < 5 is not (x < 5)
+            token = self.next()
+            operand = self.parse_binary(level)
+            if not is_condition(operand):
+                raise self.error("Operand of 'not' must be a condition", token)
+            return ("not", operand, None)
+        left = self.parse_binary(level + 1)
+        while True:
+            token = self.peek()
+            if token[1] not in ops or token[0] not in ("op", "name"):
+                return left
+            self.next()
+            right = self.parse_binary(level + 1)
+            op = token[1]
+            # "and"/"or" join conditions; every other operator takes values.
+            want_condition = op in ("and", "or")
+            for operand in (left, right):
+                if is_condition(operand) != want_condition:
+                    kind = "a condition" if want_condition else "a value"
+                    raise self.error(f"Operands of {op!r} must be {kind}", token)
+            left = (op, left, right)
+
+    def parse_unary(self):
+        if self.accept("-"):
+            return ("-", 0, self.parse_unary())
+        return self.parse_primary()
+
+    def parse_primary(self):
+        token = self.next()
+        kind, value = token[0], token[1]
+        if kind in ("number", "char"):
+            return value
+        if kind == "name":
+            if value in CONSTANTS:
+                return CONSTANTS[value]()
+            return value
+        if kind == "op" and value == "(":
+            node = self.parse_binary(0)
+            self.expect(")")
+            return node
+        raise self.error(f"Unexpected {self.describe(token)}", token)
@@ -0,0 +1,187 @@
+# Peephole optimizer for the assembly the Compiler emits.
+#
+# Works on the structured instructions the Compiler builds (the form of
+# assembler.parse_line, with ints for numeric A values) and only ever looks at
+# straight-line code: a label means control can arrive from elsewhere, so any
+# knowledge about register contents is dropped there. Instructions can be
+# deleted freely because every jump target is a label, never a raw address.
+#
+# Passes (all on by default, select with optimize(..., passes=...)):
+#   forward  store-load forwarding: drop D=M / M=D when D already equals M
+#   aload    redundant A-load elimination: drop @X when A already holds X
+#   const    fold 0/1 constants: "@0 / D=A" -> "D=0", "D=0 / @Y / M=D" -> "@Y / M=0"
+#   thread   jump threading: retarget jumps whose target is itself a jump,
+#            and drop jumps to the very next instruction
+
+
+PASSES = ("forward", "aload", "const", "thread")
+
+def reads_a(instr):
+    _, _, dest, comp, jump = instr
+    return "A" in comp or "M" in comp or (dest is not None and "M" in dest) or jump is not None
+
+def reads_d(instr):
+    _, prnt, _, comp, jump = instr
+    # Every jump except JMP tests D, and printing prints D.
+    return "D" in comp or prnt != "NO_PRINT" or (jump is not None and jump != "JMP")
+
+def writes(instr, register):
+    dest = instr[2]
+    return dest is not None and register in dest
+
+def is_dead(instrs, start, register):
+    """True if `register` ("A" or "D") is overwritten before it is read on the
+    fall-through path starting at instrs[start]. Unconditional jumps leave
+    the straight-line code, so the register counts as live there."""
+    for i in range(start, len(instrs)):
+        instr = instrs[i]
+        if instr[0] == "label":
+            continue
+        if instr[0] == "a":
+            if register == "A":
+                return True
+            continue
+        if register == "A" and reads_a(instr):
+            return False
+        if register == "D" and reads_d(instr):
+            return False
+        if writes(instr, register):
+            return True
+        if instr[4] is not None:
+            return False
+    return True
+
+def forward_and_aload(instrs, passes):
+    # One scan tracking what A holds (a symbol or None) and whether D equals
+    # RAM[A].
+    out = []
+    a_value = None
+    d_is_m = False
+    for instr in instrs:
+        if instr[0] == "label":
+            a_value = None
+            d_is_m = False
+        elif instr[0] == "a":
+            if "aload" in passes and instr[1] == a_value:
+                continue
+            a_value = instr[1]
+            d_is_m = False
+        else:
+            _, prnt, dest, comp, jump = instr
+            if "forward" in passes and d_is_m and prnt == "NO_PRINT" and jump is None:
+                if (dest, comp) in (("D", "M"), ("M", "D")):
+                    continue
+            if dest is not None:
+                if "A" in dest:
+                    a_value = None
+                    d_is_m = False
+                elif dest in ("MD", "DM"):
+                    d_is_m = True
+                elif dest == "D":
+                    d_is_m = comp == "M"
+                elif dest == "M":
+                    d_is_m = comp == "D"
+        out.append(instr)
+    return out
+
+def fold_constants(instrs):
+    out = []
+    i = 0
+    while i < len(instrs):
+        instr = instrs[i]
+        # @0 / D=A  ->  D=0 (and @1 / D=A -> D=1) when A is not needed after
+        if (instr[0] == "a" and instr[1] in (0, 1) and i + 1 < len(instrs)
+                and instrs[i + 1] == ("c", "NO_PRINT", "D", "A", None)
+                and is_dead(instrs, i + 2, "A")):
+            out.append(("c", "NO_PRINT", "D", str(instr[1]), None))
+            i += 2
+            continue
+        # D=k / @Y / M=D  ->  @Y / M=k when D is not needed after
+        if (instr[0] == "c" and instr[1:] in (("NO_PRINT", "D", "0", None), ("NO_PRINT", "D", "1", None))
+                and i + 2 < len(instrs) and instrs[i + 1][0] == "a"
+                and instrs[i + 2] == ("c", "NO_PRINT", "M", "D", None)
+                and is_dead(instrs, i + 3, "D")):
+            out.append(instrs[i + 1])
+            out.append(("c", "NO_PRINT", "M", instr[3], None))
+            i += 3
+            continue
+        out.append(instr)
+        i += 1
+    return out
+
+def thread_jumps(instrs):
+    positions = {instr[1]: i for i, instr in enumerate(instrs) if instr[0] == "label"}
+
+    def first_instr(label):
+        i = positions[label]
+        while i < len(instrs) and instrs[i][0] == "label":
+            i += 1
+        return i
+
+    def final_target(label):
+        # Follow "@L2 / 0;JMP" chains, stopping at cycles.
+        seen = {label}
+        while True:
+            i = first_instr(label)
+            if (i + 1 < len(instrs) and instrs[i][0] == "a"
+                    and instrs[i + 1] == ("c", "NO_PRINT", None, "0", "JMP")
+                    and instrs[i][1] in positions and instrs[i][1] not in seen):
+                label = instrs[i][1]
+                seen.add(label)
+            else:
+                return label
+
+    out = []
+    i = 0
+    while i < len(instrs):
+        instr = instrs[i]
+        if (instr[0] == "a" and instr[1] in positions and i + 1 < len(instrs)
+                and instrs[i + 1][0] == "c" and instrs[i + 1][4] is not None):
+            jump = instrs[i + 1]
+            _, prnt, dest, comp, cond = jump
+            unconditional = cond == "JMP" and comp == "0"
+            # The jump itself must not use A for anything but the target.
+            uses_a = "A" in comp or "M" in comp or (dest is not None and "M" in dest)
+            target_pos = positions[instr[1]]
+            # A jump to the instruction right after it does nothing.
+            if (unconditional and prnt == "NO_PRINT" and dest is None and target_pos > i
+                    and all(instrs[k][0] == "label" for k in range(i + 2, target_pos))
+                    and is_dead(instrs, target_pos, "A")):
+                i += 2
+                continue
+            target = final_target(instr[1])
+            # Taken, A ends up holding the final target either way; falling
+            # through a conditional jump it would differ, so A must be dead.
+            if (target != instr[1] and not uses_a
+                    and (unconditional or is_dead(instrs, i + 2, "A"))):
+                out.append(("a", target))
+                out.append(jump)
+                i += 2
+                continue
+        out.append(instr)
+        i += 1
+    return out
+
+def optimize(instrs, passes=PASSES):
+    """Optimize a list of structured instructions.
+
+    Returns ``(instrs, removed)`` where removed is how many instructions
+    (not counting labels) were eliminated.
+    """
+    unknown = set(passes) - set(PASSES)
+    if unknown:
+        raise ValueError(f"Unknown peephole passes: {', '.join(sorted(unknown))}")
+    before = sum(1 for instr in instrs if instr[0] != "label")
+    while True:
+        size = len(instrs)
+        previous = instrs
+        if "forward" in passes or "aload" in passes:
+            instrs = forward_and_aload(instrs, passes)
+        if "const" in passes:
+            instrs = fold_constants(instrs)
+        if "thread" in passes:
+            instrs = thread_jumps(instrs)
+        if len(instrs) == size and instrs == previous:
+            break
+    after = sum(1 for instr in instrs if instr[0] != "label")
+    return instrs, before - after
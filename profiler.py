@@ -0,0 +1,112 @@
+# Execution profile for CPU.run(profile=...).
+#
+# The profiled run counts how often every ROM address executes and, for each
+# jump, how often it was taken. report() maps the counts back to the labels
+# from assemble(..., with_labels=True) (Compiler.labels), so a hot
+# WHILE_START3 or MUL_LOOP points at the source loop or runtime routine that
+# is responsible; with Compiler.label_lines the loops also show their source
+# line. Without labels (e.g. for a ROM image) addresses are used.
+
+import re
+from array import array
+
+# Loops the compiler emits as NAME_START<n> ... NAME_END<n+1> (the two
+# labels take consecutive numbers from Compiler.label_count)
+LOOP_RE = re.compile(r"^(WHILE|FOR)_START(\d+)$")
+
+class Profile:
+    def __init__(self, rom_size, labels=None, label_lines=None):
+        self.counts = array("Q", bytes(8 * rom_size))  # executions per address
+        self.taken = array("Q", bytes(8 * rom_size))  # jumps taken per address
+        self.not_taken = array("Q", bytes(8 * rom_size))
+        self.labels = dict(labels or {})
+        self.label_lines = dict(label_lines or {})  # label -> source line
+
+    @property
+    def total(self):
+        return sum(self.counts)
+
+    def label_starts(self):
+        """Sorted (address, name) pairs, one per labelled address; several
+        labels on one address are joined with a slash."""
+        names = {}
+        for name, address in self.labels.items():
+            if address < len(self.counts):
+                names.setdefault(address, []).append(name)
+        return [(address, "/".join(sorted(names[address]))) for address in sorted(names)]
+
+    def location(self, pc):
+        """Describe an address relative to the closest label before it."""
+        best = None
+        for address, name in self.label_starts():
+            if address > pc:
+                break
+            best = (address, name)
+        if best is None:
+            return str(pc)
+        return best[1] if best[0] == pc else f"{best[1]}+{pc - best[0]}"
+
+    def regions(self):
+        """(name, start, end, count) for every run of addresses from one label
+        to the next, hottest first. Code before the first label is "<start>"."""
+        starts = self.label_starts()
+        if not starts or starts[0][0] != 0:
+            starts.insert(0, (0, "<start>"))
+        bounds = starts + [(len(self.counts), None)]
+        regions = []
+        for (start, name), (end, _) in zip(bounds, bounds[1:]):
+            if end > start:
+                regions.append((name, start, end, sum(self.counts[start:end])))
+        regions.sort(key=lambda r: -r[3])
+        return regions
+
+    def loops(self):
+        """(name, start, end, count) for every compiled while/for loop,
+        including the loops nested inside it, hottest first."""
+        loops = []
+        for name, start in self.labels.items():
+            m = LOOP_RE.match(name)
+            if not m:
+                continue
+            end = self.labels.get(f"{m.group(1)}_END{int(m.group(2)) + 1}")
+            if end is not None and end > start:
+                loops.append((name, start, end, sum(self.counts[start:end])))
+        loops.sort(key=lambda r: -r[3])
+        return loops
+
+    def jumps(self):
+        """(pc, taken, not_taken) for every jump that executed, most executed
+        first."""
+        jumps = [(pc, self.taken[pc], self.not_taken[pc]) for pc in range(len(self.counts))
+                 if self.taken[pc] or self.not_taken[pc]]
+        jumps.sort(key=lambda j: -(j[1] + j[2]))
+        return jumps
+
+    def report(self, top=10):
+        total = self.total
+        def percent(count):
+            return f"{100 * count / total:6.2f}%" if total else "   -   "
+
+        lines = [f"Profile: {total} instructions executed", ""]
+        lines.append("Hot spots by label")
+        lines.append(f"{'count':>12} {'share':>7}  {'addresses':<13} label")
+        for name, start, end, count in self.regions()[:top]:
+            if count:
+                lines.append(f"{count:12d} {percent(count)}  {f'{start}-{end - 1}':<13} {name}")
+
+        loops = self.loops()
+        if loops:
+            lines += ["", "Loops (including nested loops)"]
+            lines.append(f"{'count':>12} {'share':>7}  {'addresses':<13} {'loop':<16} line")
+            for name, start, end, count in loops[:top]:
+                line = self.label_lines.get(name, "-")
+                lines.append(f"{count:12d} {percent(count)}  {f'{start}-{end - 1}':<13} {name:<16} {line}")
+
+        jumps = self.jumps()
+        if jumps:
+            lines += ["", "Jumps"]
+            lines.append(f"{'address':>8}  {'location':<20} {'taken':>12} {'not taken':>12} {'taken':>7}")
+            for pc, taken, not_taken in jumps[:top]:
+                ratio = f"{100 * taken / (taken + not_taken):6.2f}%"
+                lines.append(f"{pc:8d}  {self.location(pc):<20} {taken:12d} {not_taken:12d} {ratio}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,211 @@
+# The runtime routines compiled code calls for multiplication and division,
+# kept apart from compiler.py so that idioms.py can build the templates it
+# matches them by without loading the compiler. Each write_<name>(out) emits
+# the routine through out.label(), out.load(), out.write() and
+# out.get_var_addr(); Compiler.finish() passes itself, idioms.routines() a
+# recorder. ROUTINES maps routine names to their writers.
+
+from alu import WIDTH
+
+def write_mul(out):
+    # D = R13 * R14 by shift-and-add. R13 doubles every round, mask walks
+    # up the bits of R14, and every set bit of R14 is cleared as its
+    # multiple of R13 is added into R15, so the loop stops as soon as R14
+    # has no bits left: at most 64 rounds, fewer for small operands.
+    # Wraparound is modulo 2**64, which makes negative operands come out
+    # right without any sign handling.
+    mask = out.get_var_addr("__mul_mask")
+    ret = out.get_var_addr("__mul_ret")
+    out.label("MUL")
+    out.load("R15")
+    out.write("M=0")  # result = 0
+    out.load(mask)
+    out.write("M=1")  # mask = 1
+    out.label("MUL_LOOP")
+    out.load("R14")
+    out.write("D=M")
+    out.load("MUL_END")
+    out.write("D;JEQ")  # no bits left in R14
+    out.load(mask)
+    out.write("D=M")
+    out.load("R14")
+    out.write("D=D&M")
+    out.load("MUL_SKIP")
+    out.write("D;JEQ")  # this bit of R14 is clear
+    out.load(mask)
+    out.write("D=M")
+    out.load("R14")
+    out.write("M=M-D")  # clear the bit
+    out.load("R13")
+    out.write("D=M")
+    out.load("R15")
+    out.write("M=D+M")  # result += R13
+    out.label("MUL_SKIP")
+    out.load("R13")
+    out.write("D=M")
+    out.write("M=D+M")  # R13 *= 2
+    out.load(mask)
+    out.write("D=M")
+    out.write("M=D+M")  # mask *= 2
+    out.load("MUL_LOOP")
+    out.write("0;JMP")
+    out.label("MUL_END")
+    out.load("R15")
+    out.write("D=M")
+    out.load(ret)
+    out.write("A=M")
+    out.write("0;JMP")
+
+def write_div(out):
+    # R13 / R14 by restoring binary long division: quotient in R13,
+    # remainder in R15. Both operands are made non-negative first and
+    # the signs put back at the end, so the quotient truncates toward
+    # zero and the remainder takes the dividend's sign. Each round
+    # shifts the top bit of the dividend into the remainder and
+    # subtracts the divisor if it fits; leading zero bits of the
+    # dividend are skipped first, so small operands take few rounds.
+    # Dividing by zero gives quotient 0 and remainder = dividend.
+    q = out.get_var_addr("__div_q")
+    count = out.get_var_addr("__div_count")
+    q_neg = out.get_var_addr("__div_qneg")
+    r_neg = out.get_var_addr("__div_rneg")
+    ret = out.get_var_addr("__div_ret")
+    out.label("DIV")
+    out.load("R14")
+    out.write("D=M")
+    out.load("DIV_ZERO")
+    out.write("D;JEQ")
+    out.load(q_neg)
+    out.write("M=0")
+    out.load(r_neg)
+    out.write("M=0")
+    out.load("R13")
+    out.write("D=M")
+    out.load("DIV_NPOS")
+    out.write("D;JGE")
+    out.load("R13")
+    out.write("M=-D")  # dividend = -dividend
+    out.load(q_neg)
+    out.write("M=-1")
+    out.load(r_neg)
+    out.write("M=-1")
+    out.label("DIV_NPOS")
+    out.load("R14")
+    out.write("D=M")
+    out.load("DIV_DPOS")
+    out.write("D;JGE")
+    out.load("R14")
+    out.write("M=-D")  # divisor = -divisor
+    out.load(q_neg)
+    out.write("M=!M")
+    out.label("DIV_DPOS")
+    out.load("R15")
+    out.write("M=0")  # remainder = 0
+    out.load(q)
+    out.write("M=0")  # quotient = 0
+    out.load(WIDTH)
+    out.write("D=A")
+    out.load(count)
+    out.write("M=D")
+    out.label("DIV_SKIP")  # drop leading zero bits of the dividend
+    out.load(count)
+    out.write("D=M")
+    out.load("DIV_SIGN")
+    out.write("D;JEQ")  # the dividend was 0
+    out.load("R13")
+    out.write("D=M")
+    out.load("DIV_LOOP")
+    out.write("D;JLT")  # top bit set
+    out.load("R13")
+    out.write("M=D+M")
+    out.load(count)
+    out.write("M=M-1")
+    out.load("DIV_SKIP")
+    out.write("0;JMP")
+    out.label("DIV_LOOP")
+    out.load("R15")
+    out.write("D=M")
+    out.write("M=D+M")  # remainder *= 2
+    out.load("R13")
+    out.write("D=M")
+    out.load("DIV_SHIFT")
+    out.write("D;JGE")
+    out.load("R15")
+    out.write("M=M+1")  # ... plus the top bit of the dividend
+    out.label("DIV_SHIFT")
+    out.load("R13")
+    out.write("D=M")
+    out.write("M=D+M")  # dividend *= 2
+    out.load(q)
+    out.write("D=M")
+    out.write("M=D+M")  # quotient *= 2
+    # Unsigned remainder >= divisor? The remainder can reach 2**63 and
+    # more, so only compare by subtraction when both have the same top bit.
+    out.load("R15")
+    out.write("D=M")
+    out.load("DIV_RHIGH")
+    out.write("D;JLT")
+    out.load("R14")
+    out.write("D=M")
+    out.load("DIV_NEXT")
+    out.write("D;JLT")
+    out.label("DIV_CMP")
+    out.load("R15")
+    out.write("D=M")
+    out.load("R14")
+    out.write("D=D-M")
+    out.load("DIV_NEXT")
+    out.write("D;JLT")
+    out.label("DIV_SUB")
+    out.load("R14")
+    out.write("D=M")
+    out.load("R15")
+    out.write("M=M-D")  # remainder -= divisor
+    out.load(q)
+    out.write("M=M+1")
+    out.label("DIV_NEXT")
+    out.load(count)
+    out.write("MD=M-1")
+    out.load("DIV_LOOP")
+    out.write("D;JNE")
+    out.label("DIV_SIGN")
+    out.load(q_neg)
+    out.write("D=M")
+    out.load("DIV_QPOS")
+    out.write("D;JEQ")
+    out.load(q)
+    out.write("M=-M")
+    out.label("DIV_QPOS")
+    out.load(r_neg)
+    out.write("D=M")
+    out.load("DIV_RPOS")
+    out.write("D;JEQ")
+    out.load("R15")
+    out.write("M=-M")
+    out.label("DIV_RPOS")
+    out.load(q)
+    out.write("D=M")
+    out.load("R13")
+    out.write("M=D")
+    out.load(ret)
+    out.write("A=M")
+    out.write("0;JMP")
+    out.label("DIV_RHIGH")  # remainder >= 2**63
+    out.load("R14")
+    out.write("D=M")
+    out.load("DIV_SUB")
+    out.write("D;JGE")
+    out.load("DIV_CMP")
+    out.write("0;JMP")
+    out.label("DIV_ZERO")
+    out.load("R13")
+    out.write("D=M")
+    out.load("R15")
+    out.write("M=D")
+    out.load("R13")
+    out.write("M=0")
+    out.load(ret)
+    out.write("A=M")
+    out.write("0;JMP")
+
+ROUTINES = {"MUL": write_mul, "DIV": write_div}
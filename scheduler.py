@@ -0,0 +1,48 @@
+# Cooperative scheduling of many CPUs on one asyncio event loop.
+#
+# Each CPU runs as a task that executes `quota` instructions with
+# CPU.run_for() and then yields to the event loop, so every guest program
+# gets a turn in round-robin order and a `while True` program cannot starve
+# the others. A total step budget per CPU stops programs that never halt.
+#
+#     scheduler = Scheduler(quota=5000)
+#     for rom in roms:
+#         scheduler.add(CPU(rom, output=CaptureSink(), ram_size=1024))
+#     statuses = asyncio.run(scheduler.run())
+
+import asyncio
+from cpu import EXHAUSTED
+
+DEFAULT_QUOTA = 10000
+
+async def run_cpu(cpu, quota=DEFAULT_QUOTA, max_steps=None):
+    """Run `cpu` in slices of `quota` instructions, yielding to the event loop
+    between slices. Returns the final status from CPU.run_for(); EXHAUSTED
+    means max_steps (counted from now) ran out before the program halted."""
+    limit = None if max_steps is None else cpu.steps + max_steps
+    while True:
+        budget = quota if limit is None else min(quota, limit - cpu.steps)
+        status = cpu.run_for(budget)
+        if status != EXHAUSTED or (limit is not None and cpu.steps >= limit):
+            return status
+        await asyncio.sleep(0)
+
+class Scheduler:
+    def __init__(self, quota=DEFAULT_QUOTA):
+        self.quota = quota  # default instructions per turn
+        self.jobs = []  # (cpu, quota, max_steps)
+
+    def add(self, cpu, quota=None, max_steps=None):
+        """Queue a CPU. quota overrides the scheduler's slice size for this
+        CPU (a larger quota means a larger share of the time); max_steps
+        caps the instructions it may execute in total."""
+        self.jobs.append((cpu, quota or self.quota, max_steps))
+        return cpu
+
+    async def run(self):
+        """Run every queued CPU until it halts, fails or exhausts its
+        max_steps. Returns the statuses in the order the CPUs were added."""
+        jobs, self.jobs = self.jobs, []
+        tasks = [asyncio.create_task(run_cpu(cpu, quota, max_steps))
+                 for cpu, quota, max_steps in jobs]
+        return await asyncio.gather(*tasks)
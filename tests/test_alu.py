@@ -0,0 +1,59 @@
+# The integer ALUs against the bit-string reference model, for every Hack comp
+# and every other setting of the six control bits.
+
+import itertools
+
+import pytest
+
+from alu import MASK, SIGN, WIDTH, alu, alu_fn, alu_int
+from assembler import comp_table
+from compiler import Compiler
+from cpu import CPU
+from output import CaptureSink
+from parser import compile_source
+
+OPERANDS = [0, 1, 2, 3, 7, 0x7FFF, 0x8000, 0xFFFF, 12345678901234567,
+            SIGN - 1, SIGN, SIGN + 1, MASK - 1, MASK, 0x5555555555555555, 0xAAAAAAAAAAAAAAAA]
+
+def control_bits(comp):
+    bits = comp_table[comp][1:]  # zx,nx,zy,ny,f,no after the a bit
+    return [int(bit) for bit in bits]
+
+@pytest.mark.parametrize("comp", sorted(comp_table))
+def test_integer_alus_match_reference(comp):
+    controls = control_bits(comp)
+    specialised = alu_fn(*controls)
+    for x in OPERANDS:
+        for y in OPERANDS:
+            out, zr, ng = alu(format(x, f"0{WIDTH}b"), format(y, f"0{WIDTH}b"), *controls)
+            expected = int(out, 2)
+            assert alu_int(x, y, *controls) == (expected, int(zr), int(ng)), (comp, x, y)
+            assert specialised(x, y) == expected, (comp, x, y)
+
+@pytest.mark.parametrize("controls", list(itertools.product((0, 1), repeat=6)))
+def test_all_control_bits_match_reference(controls):
+    specialised = alu_fn(*controls)
+    for x in OPERANDS[::3]:
+        for y in OPERANDS[1::3]:
+            out, zr, ng = alu(format(x, f"0{WIDTH}b"), format(y, f"0{WIDTH}b"), *controls)
+            expected = int(out, 2)
+            assert alu_int(x, y, *controls) == (expected, int(zr), int(ng)), (controls, x, y)
+            assert specialised(x, y) == expected, (controls, x, y)
+
+def test_reference_mode_runs_the_same():
+    source = """
+        x = 0 - 7
+        y = 6
+        for (i = 0; i < 5; i++) { x = x * y - i; y = y / 2 + i }
+        print(x, \\n)
+        print(y, \\n)
+    """
+    compiler = Compiler()
+    rom = compile_source(source, compiler)
+    outputs = []
+    for reference_alu in (False, True):
+        sink = CaptureSink()
+        cpu = CPU(rom, reference_alu=reference_alu, output=sink, ram_init=compiler.ram_init)
+        cpu.run()
+        outputs.append((sink.getvalue(), cpu.steps, bytes(cpu.ram[:64])))
+    assert outputs[0] == outputs[1]
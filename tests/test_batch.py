@@ -0,0 +1,16 @@
+from assembler import pack_image
+from batch import run_job
+from cpu import CPU, ERROR, HALTED
+
+def image_job(rom, ram_init=None):
+    return {"file": "test.lava", "image": pack_image(rom, "hack", ram_init),
+            "source": None, "cache_key": None, "isa": "hack"}
+
+def test_image_runs():
+    assert run_job(image_job([0]))["status"] == HALTED
+
+def test_cpu_that_cannot_start_is_an_error():
+    # Initial RAM past the end of memory makes CPU() itself fail
+    result = run_job(image_job([0], {len(CPU([0]).ram) + 5: 1}))
+    assert result["status"] == ERROR
+    assert result["error"].startswith("IndexError")
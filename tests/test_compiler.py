@@ -0,0 +1,17 @@
+from compiler import Compiler
+from cpu import CPU
+from output import CaptureSink
+from parser import compile_source
+
+def run(source):
+    compiler = Compiler()
+    rom = compile_source(source, compiler)
+    sink = CaptureSink()
+    CPU(rom, output=sink, ram_init=compiler.ram_init).run()
+    return sink.getvalue()
+
+def test_string_characters_print_their_low_byte():
+    # PRINT_CHAR prints chr(D & 0xFF); code points past 0x7FFF must still
+    # compile. The CPU ends the output line when it halts.
+    text = "hé \U0001F600 €"
+    assert run(f'println("{text}")') == bytes(ord(c) & 0xFF for c in text) + b"\n"
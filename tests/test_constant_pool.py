@@ -0,0 +1,52 @@
+# Constants an A-instruction cannot hold live in RAM (Compiler.constant());
+# the values must survive a fresh compile, a compile cache hit and a ROM
+# image written with -o.
+
+import os
+import subprocess
+import sys
+
+import pytest
+
+from cache import CompileCache, isa_options
+from compiler import Compiler
+from parser import compile_source
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SOURCE = """
+x = 100000
+y = 0 - 5
+print(x, \\n)
+print(y, \\n)
+print(x * 3 + 40000, \\n)
+print(-70000, \\n)
+print(9223372036854775807, \\n)
+"""
+EXPECTED = "100000\n-5\n340000\n-70000\n9223372036854775807\n\n"
+
+def melt(*args):
+    result = subprocess.run([sys.executable, os.path.join(ROOT, "melt"), *args],
+                            capture_output=True, text=True, check=True)
+    return result.stdout
+
+@pytest.mark.parametrize("isa", ["hack", "extended"])
+def test_constants_survive_cache_and_image(tmp_path, isa):
+    program = tmp_path / "wide.ls"
+    program.write_text(SOURCE)
+    cache_dir = tmp_path / "cache"
+    compiler = Compiler(isa=isa)
+    compile_source(SOURCE, compiler)
+    assert compiler.ram_init  # the program really uses the pool
+
+    assert melt(str(program), "--no-cache", f"--isa={isa}") == EXPECTED
+    # The first cached run compiles and stores, the second loads
+    cache = CompileCache(str(cache_dir))
+    key = cache.key(SOURCE, isa_options(isa))
+    assert melt(str(program), "--cache-dir", str(cache_dir), f"--isa={isa}") == EXPECTED
+    assert cache.get(key)[2] == compiler.ram_init
+    assert melt(str(program), "--cache-dir", str(cache_dir), f"--isa={isa}") == EXPECTED
+
+    image = tmp_path / "wide.lava"
+    melt(str(program), "--no-cache", f"--isa={isa}", "-o", str(image))
+    assert melt(str(image)) == EXPECTED
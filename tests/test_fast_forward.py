@@ -0,0 +1,128 @@
+# Fast-forwarded runs (idioms.py) must leave exactly the state stepping does:
+# the same output, RAM, registers and instruction count, also when run_for()
+# slices end in the middle of a fast-forwarded loop.
+
+import glob
+import os
+
+import pytest
+
+from assembler import split_word
+from compiler import Compiler
+from cpu import CPU, EXHAUSTED
+from output import CaptureSink
+from parser import compile_source
+from profiler import Profile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROGRAMS = sorted(glob.glob(os.path.join(ROOT, "benchmarks", "*.ls"))
+                  + glob.glob(os.path.join(ROOT, "examples", "*.ls")))
+
+# Counted loops in the shapes idioms.loop_handler accepts, counting up and
+# down against constants and variables, with sums and copies in the body.
+# The last ones begin with a folded constant, so the rotated loop (test at
+# the bottom) starts at a C-instruction rather than an @.
+LOOPS = [
+    "s = 0\nfor (i = 0; i < 1000; i++) { s = s + i }\nprint(s, \\n)",
+    "a = 3\nb = -7\nn = 250\nt = 0\nfor (i = 500; i > n; i = i - 3) { t = t + i + i - a; u = i - b + t }\nprint(t, \\n)\nprint(u, \\n)",
+    "c = 17\nu = 0\nfor (i = -20; i < c; i = i + 1) { u = u + i; w = u }\nprint(u, \\n)\nprint(w, \\n)",
+    "x = 123456\ny = 789\nprint(x * y, \\n)\nprint(x / y, \\n)\nprint(0 - x % y, \\n)",
+    "s = 0\nfor (i = 0; i < 1000; i++) { b = 0 - i; s = s + b }\nprint(s, \\n)\nprint(b, \\n)",
+    "d = 13\nfor (i = -500; i < 700; i++) { b = -i - d - d }\nprint(b, \\n)",
+    "s = 5\nfor (i = 900; i > 3; i = i - 2) { b = 0 - i; s = s - i }\nprint(s, \\n)",
+]
+
+SLICES = [None, 7, 1000]
+
+def state(rom, ram_init, engine, fast_forward, slice_steps):
+    sink = CaptureSink()
+    cpu = CPU(rom, engine=engine, output=sink, fast_forward=fast_forward, ram_init=ram_init)
+    if slice_steps is None:
+        cpu.run()
+    else:
+        while cpu.run_for(slice_steps) == EXHAUSTED:
+            pass
+    return sink.getvalue(), bytes(cpu.ram), bytes(cpu.written), cpu.A, cpu.D, cpu.pc, cpu.steps
+
+def sources():
+    for path in PROGRAMS:
+        with open(path) as f:
+            yield os.path.basename(path), f.read()
+    for n, source in enumerate(LOOPS):
+        yield f"loop{n}", source
+
+SOURCES = list(sources())
+
+@pytest.mark.parametrize("name,source", SOURCES, ids=[name for name, _ in SOURCES])
+@pytest.mark.parametrize("engine", ["interp", "blocks"])
+def test_fast_forward_matches_stepping(name, source, engine):
+    compiler = Compiler()
+    rom = compile_source(source, compiler)
+    if name.startswith("loop"):
+        assert CPU(rom).idioms, f"{name}: nothing to fast-forward"
+    for slice_steps in SLICES:
+        if slice_steps == 7 and name.endswith(".ls"):
+            continue  # millions of steps; the generated loops cover small slices
+        fast = state(rom, compiler.ram_init, engine, True, slice_steps)
+        slow = state(rom, compiler.ram_init, engine, False, slice_steps)
+        assert fast == slow, (name, slice_steps)
+
+def test_loop_longer_than_a_slice_fast_forwards():
+    # Rounds that fit the run_for() budget are skipped, not stepped
+    rom = compile_source("s = 0\nfor (i = 0; i < 30000; i++) { s = s + i }\nprint(s, \\n)")
+    cpu = CPU(rom, output=CaptureSink())
+    stepped = 0
+    step = cpu.step
+    def counting_step():
+        nonlocal stepped
+        stepped += 1
+        step()
+    cpu.step = counting_step
+    assert cpu.run_for(10000) == EXHAUSTED
+    assert cpu.steps == 10000
+    assert stepped < 100
+
+def test_loops_include_c_instruction_starts():
+    starts = set()
+    for source in LOOPS:
+        rom = compile_source(source, Compiler())
+        starts |= {split_word(rom[pc])[0] for pc in CPU(rom).idioms}
+    assert starts == {"a", "c"}
+
+# Loops whose fast-forward starts at a C-instruction (the peephole passes
+# turn "@0 D=A" into "D=0"). Stepped, or when the handler declines, the CPU
+# must run that instruction: the first loop's operands are too wide for a
+# closed form, and small run_for() budgets do not fit a whole loop.
+DECLINED = {
+    "wide_operands": "n = 4611686018427387904\nfor (j = n; j < n + 3; j++) { b = 0 - j }\nprint(b, \\n)",
+    "folded_constant": "d = 13\nfor (i = -1; i < 1; i++) { b = -i - d - d }\nprint(b, \\n)",
+}
+
+@pytest.mark.parametrize("name", sorted(DECLINED))
+@pytest.mark.parametrize("engine", ["interp", "blocks"])
+def test_declined_idiom_runs_its_instruction(name, engine):
+    compiler = Compiler()
+    rom = compile_source(DECLINED[name], compiler)
+    assert any(split_word(rom[pc])[0] == "c" for pc in CPU(rom).idioms)
+    for slice_steps in (None, 1, 2, 3, 5, 7):
+        fast = state(rom, compiler.ram_init, engine, True, slice_steps)
+        slow = state(rom, compiler.ram_init, engine, False, slice_steps)
+        assert fast == slow, slice_steps
+
+def profiled(rom, ram_init, fast_forward):
+    sink = CaptureSink()
+    cpu = CPU(rom, output=sink, fast_forward=fast_forward, ram_init=ram_init)
+    profile = Profile(len(rom))
+    cpu.run(profile=profile)
+    return (sink.getvalue(), cpu.steps, list(profile.counts), list(profile.taken),
+            list(profile.not_taken))
+
+PROFILED = sorted(DECLINED.items()) + [(f"loop{n}", source) for n, source in enumerate(LOOPS)]
+
+@pytest.mark.parametrize("name,source", PROFILED, ids=[name for name, _ in PROFILED])
+def test_profiled_run_matches_stepping(name, source):
+    # Profiled runs step every instruction, idiom starts included, and count
+    # their jumps.
+    compiler = Compiler()
+    rom = compile_source(source, compiler)
+    assert profiled(rom, compiler.ram_init, True) == profiled(rom, compiler.ram_init, False)
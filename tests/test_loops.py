@@ -0,0 +1,135 @@
+# The loop pass (loops.py) must not change what a program prints: each
+# program runs compiled with loops=True and loops=False.
+
+import itertools
+
+import pytest
+
+from compiler import Compiler
+from cpu import CPU
+from lexer import tokenize
+from loops import optimize_loop
+from output import CaptureSink
+from parser import Parser, compile_source
+
+PROGRAMS = {
+    # x = k * 2 is invariant, but the round reads x before assigning it,
+    # so the first round must see the old x.
+    "read_before_assign": """
+        x = 5
+        k = 3
+        s = 0
+        for (i = 0; i < 4; i++) { s = s + x; x = k * 2 }
+        print(s, \\n)
+        print(x, \\n)
+    """,
+    # The same, with the read inside an if and a nested loop.
+    "read_before_assign_nested": """
+        x = 1
+        k = 7
+        s = 0
+        for (i = 0; i < 5; i++) {
+            if i > 2 { s = s + x }
+            for (j = 0; j < 2; j++) { s = s + x * j }
+            x = k + 4
+        }
+        print(s, \\n)
+    """,
+    # Chained invariants: moving y frees z, which reads it.
+    "chained_invariants": """
+        a = 6
+        s = 0
+        n = 0
+        while n < 6 { y = a * 3; z = y - 1; s = s + z * n; n = n + 1 }
+        print(s, \\n)
+    """,
+    # i steps twice a round, so i * m is not an induction product.
+    "reassigned_induction": """
+        m = 9
+        s = 0
+        for (i = 0; i < 20; i++) { s = s + i * m; i = i + 2; s = s + i * m }
+        print(s, \\n)
+    """,
+    # i is stepped in an if, so it is no induction variable.
+    "induction_in_if": """
+        m = 11
+        s = 0
+        i = 0
+        n = 0
+        while n < 12 { s = s + i * m; if n % 3 == 0 { i = i + 5 } n = n + 1 }
+        print(s, \\n)
+    """,
+    # i is assigned something else once the round is over.
+    "induction_reset": """
+        m = 4
+        s = 0
+        i = 0
+        n = 0
+        while n < 10 { i = i + 3; s = s + i * m; if i > 12 { i = 1 } n = n + 1 }
+        print(s, \\n)
+    """,
+    # Products of the induction variable inside ifs and inner loops, and
+    # one that wraps past 2**63.
+    "nested_products": """
+        m = 13
+        w = 4611686018427387904
+        s = 0
+        t = 0
+        for (i = 0; i < 9; i++) {
+            if i % 2 == 0 {
+                if i > 3 { s = s + i * m } else { s = s - m * i }
+            }
+            for (j = 0; j < 3; j++) { s = s + i * m + j; t = t + i * w }
+            k = 0
+            while k < i { s = s + i * 2; k = k + 1 }
+        }
+        print(s, \\n)
+        print(t, \\n)
+    """,
+    # A counting-down loop with a product in its condition.
+    "product_in_condition": """
+        m = 3
+        s = 0
+        for (i = 30; i * m > 10; i = i - 4) { s = s + i * m }
+        print(s, \\n)
+    """,
+    # Loops that never run must not run their setup either.
+    "loop_not_run": """
+        k = 2
+        x = 100
+        for (i = 5; i < 0; i++) { x = k * 7; y = i * k }
+        print(x, \\n)
+    """,
+}
+
+def output(source, loops):
+    compiler = Compiler(loops=loops)
+    rom = compile_source(source, compiler)
+    sink = CaptureSink()
+    CPU(rom, output=sink, ram_init=compiler.ram_init).run()
+    return sink.getvalue()
+
+@pytest.mark.parametrize("name", sorted(PROGRAMS))
+def test_loop_pass_keeps_output(name):
+    source = PROGRAMS[name]
+    assert output(source, True) == output(source, False)
+
+def loop(source):
+    """optimize_loop() applied to the single while loop in source."""
+    (node,) = Parser(tokenize(source)).parse_program()
+    counter = itertools.count(1)
+    return optimize_loop(node.cond, node.body, lambda: f"t{next(counter)}")
+
+def test_invariant_assignment_moves_to_setup():
+    setup, _, body = loop("while n < 9 { x = k * 2; s = s + x; n = n + 1 }")
+    assert [node.name for node in setup] == ["x"]
+    assert [node.name for node in body] == ["s", "n"]
+
+def test_assignment_read_first_stays():
+    setup, _, body = loop("while n < 9 { s = s + x; x = k * 2; n = n + 1 }")
+    assert "x" in [node.name for node in body]
+    assert "x" not in [node.name for node in setup]
+
+def test_reassigned_induction_is_not_reduced():
+    _, _, body = loop("while i < 9 { s = s + i * m; i = i + 1; i = i + 1 }")
+    assert body[0].expr == ("+", "s", ("*", "i", "m"))